@@ -0,0 +1,67 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""
+Compares serial tarfile extraction of a bzip2 archive with the parallel decompression
+used by BaseProcess when unzip_processes is above one.
+
+Usage:
+    python benchmarks/bzip2_decompression.py [size in MB] [processes]
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import io
+import sys
+import time
+import shutil
+import tarfile
+from os.path import join
+from tempfile import mkdtemp
+
+import numpy
+
+from landsat.decompress import ParallelBZ2File
+
+
+def synthetic_archive(path, size):
+    """ Writes a tar.bz archive with a few band-like files of smooth uint16 noise """
+    rnd = numpy.random.RandomState(0)
+    with tarfile.open(path, 'w:bz2') as tar:
+        for band in range(4):
+            data = (rnd.normal(9000, 40, size // 8 // 2).cumsum() % 65535).astype(numpy.uint16).tobytes()
+            data += rnd.randint(0, 64, size // 8 // 2, dtype=numpy.uint16).tobytes()
+            info = tarfile.TarInfo('LC80030172015001LGN00_B%s.TIF' % (band + 1))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def main(size=100, processes=4):
+    folder = mkdtemp()
+    try:
+        archive = join(folder, 'LC80030172015001LGN00.tar.bz')
+        synthetic_archive(archive, size * 1048576)
+
+        start = time.time()
+        tar = tarfile.open(archive, 'r')
+        tar.extractall(join(folder, 'serial'))
+        tar.close()
+        serial = time.time() - start
+
+        start = time.time()
+        reader = ParallelBZ2File(archive, processes)
+        tar = tarfile.open(fileobj=io.BufferedReader(reader), mode='r|')
+        tar.extractall(join(folder, 'parallel'))
+        tar.close()
+        reader.close()
+        parallel = time.time() - start
+
+        print('archive: %s MB uncompressed' % size)
+        print('tarfile: %.2fs' % serial)
+        print('%s processes: %.2fs (%.1fx faster)' % (processes, parallel, serial / parallel))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,57 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""
+Compares the rescale_intensity color correction with the lookup table color correction.
+
+Usage:
+    python benchmarks/color_correction.py [size]
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import sys
+import time
+
+import numpy
+from skimage.util import img_as_ubyte
+
+from landsat.image import BaseProcess
+
+
+def synthetic_band(size):
+    """ A uint16 band with a nodata border and a few saturated pixels """
+    band = numpy.random.RandomState(0).normal(9000, 2500, (size, size)).clip(1, 65535).astype(numpy.uint16)
+    band[:, :size // 10] = 0
+    band[::97, ::89] = 65535
+    return band
+
+
+def main(size=4000):
+    p = BaseProcess.__new__(BaseProcess)
+    p.bands = [4, 3, 2]
+
+    band = synthetic_band(size)
+    coverage = 10.0
+
+    start = time.time()
+    cuts = p._color_cuts([band], 0, coverage)[0]
+    stats = time.time() - start
+
+    start = time.time()
+    expected = img_as_ubyte(p._color_correction(band, 4, 0, coverage, cuts))
+    rescale = time.time() - start
+
+    start = time.time()
+    output = p._correct_band(band, 4, 0, coverage, cuts)
+    lut = time.time() - start
+
+    print('band size: %sx%s' % (size, size))
+    print('histogram cuts: %.3fs' % stats)
+    print('rescale_intensity: %.3fs' % rescale)
+    print('lookup table: %.3fs (%.1fx faster)' % (lut, rescale / lut))
+    print('identical output: %s' % numpy.array_equal(expected, output))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,77 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""
+Compares the peak memory of the previous float64 pansharpen arithmetic with the in place
+float32 Brovey transform. Each implementation runs in a process of its own.
+
+Usage:
+    python benchmarks/pansharpen_memory.py [size]
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import sys
+import resource
+import subprocess
+
+import numpy
+
+from landsat.image import PanSharpen
+
+
+def synthetic_bands(size):
+    """ Red, green, blue and pan uint16 bands """
+    rnd = numpy.random.RandomState(0)
+    return [rnd.randint(1, 20000, (size, size)).astype(numpy.uint16) for i in range(4)]
+
+
+def peak_rss():
+    """ Peak resident memory of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1048576 if sys.platform == 'darwin' else peak / 1024
+
+
+def previous(bands):
+    """ The full scene float64 arithmetic used before the Brovey transform was done in place """
+    m = numpy.add(bands[0], bands[1])
+    numpy.add(m, bands[2], out=m)
+
+    pan = numpy.true_divide(1, m)
+    del m
+    numpy.copyto(pan, numpy.finfo(numpy.float64).max, where=numpy.isposinf(pan))
+    numpy.multiply(pan, bands[3], out=pan)
+
+    for i in range(3):
+        bands[i] = numpy.multiply(bands[i], pan)
+
+
+def brovey(bands):
+    p = PanSharpen.__new__(PanSharpen)
+    p.band8 = 3
+    p.output = lambda *args, **kwargs: None
+    p._brovey(bands)
+
+
+def run(name, size):
+    bands = synthetic_bands(size)
+    baseline = peak_rss()
+    globals()[name](bands)
+    print('%.1f %.1f' % (baseline, peak_rss()))
+
+
+def main(size=6000):
+    print('bands: 4 x %sx%s uint16' % (size, size))
+
+    for name in ('previous', 'brovey'):
+        output = subprocess.check_output([sys.executable, __file__, name, str(size)])
+        baseline, peak = [float(value) for value in output.split()]
+        print('%s: peak RSS %.1f MB, %.1f MB above the input bands' % (name, peak, peak - baseline))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('previous', 'brovey'):
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -21,7 +21,7 @@ class Mock(MagicMock):
     def __getattr__(cls, name):
             return Mock()
 
-MOCK_MODULES = ['numpy', 'rasterio', 'scipy', 'scikit-image', 'homura', 'boto',
+MOCK_MODULES = ['numpy', 'rasterio', 'scipy', 'scikit-image', 'boto',
                 'termcolor', 'requests', 'python-dateutil']
 sys.modules.update((mod_name, Mock()) for mod_name in MOCK_MODULES)
 
@@ -0,0 +1,330 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from os.path import join
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where files are not locked
+    fcntl = None
+
+from .utils import check_create_folder
+
+
+def fingerprint(*parts):
+    """ Returns a stable hash of JSON serializable values.
+
+    :param parts:
+        The values to hash
+    :type parts:
+        Any JSON serializable value
+
+    :returns:
+        (String) a hex digest
+
+    :example:
+        >>> fingerprint('LC80030172015001LGN00', [4, 3, 2])
+        '15b56ad6958bfab131e70b493c394d3035d77a85'
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_json(path, default=None):
+    """ Returns the content of a JSON file, or default if it does not exist or is not valid.
+
+    :param path:
+        Path to the file
+    :type path:
+        String
+
+    :returns:
+        The content of the file
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def write_json(path, value):
+    """ Writes a value to a JSON file. The value is written to a temporary file which is then
+    renamed, so concurrent readers never see a partial file.
+
+    :param path:
+        Path to the file
+    :type path:
+        String
+    :param value:
+        Any JSON serializable value
+    :type value:
+        Any
+
+    :returns:
+        The value
+    """
+    handle, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, 'w') as f:
+        json.dump(value, f)
+    os.rename(temp, path)
+
+    return value
+
+
+class JSONCache(object):
+    """
+    Persistent cache of small JSON documents, one file per key.
+
+    Entries are written to a temporary file and renamed, so concurrent readers never see
+    a partial entry.
+
+    :param folder:
+        The folder where the entries are stored
+    :type folder:
+        String
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, key):
+        """ Returns the path of the file that stores the key """
+        return join(self.folder, fingerprint(key) + '.json')
+
+    def get(self, key, default=None):
+        """ Returns the value stored for the key, or default if there is none.
+
+        :param key:
+            Any JSON serializable value
+        :type key:
+            Any
+
+        :returns:
+            The stored value
+        """
+        return read_json(self.path(key), default)
+
+    def set(self, key, value):
+        """ Stores a value for the key.
+
+        :param key:
+            Any JSON serializable value
+        :type key:
+            Any
+        :param value:
+            Any JSON serializable value
+        :type value:
+            Any
+
+        :returns:
+            The value
+        """
+        check_create_folder(self.folder)
+
+        return write_json(self.path(key), value)
+
+
+def link(src, dst):
+    """ Hard links src to dst, or copies it if they are on different file systems.
+
+    :param src:
+        Path to the existing file
+    :type src:
+        String
+    :param dst:
+        Path to the new file
+    :type dst:
+        String
+
+    :returns:
+        (String) dst
+    """
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+    return dst
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """ Holds an exclusive lock on a file, shared by all the processes of the host.
+
+    :param path:
+        Path to the lock file, created if it does not exist
+    :type path:
+        String
+    :param blocking:
+        Whether to wait for the lock. If False, the lock is not taken when another process holds it
+    :type blocking:
+        boolean
+
+    :returns:
+        (boolean) whether the lock is held
+    """
+    with open(path, 'a') as f:
+        acquired = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                acquired = False
+
+        try:
+            yield acquired
+        finally:
+            if acquired and fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FileCache(object):
+    """
+    Persistent cache of files with a size budget. When the files exceed the budget, the least
+    recently used ones are removed.
+
+    The last use of an entry is recorded in its access time, so the modification time of the
+    files, and of hard links to them, does not change when they are used.
+
+    :param folder:
+        The folder where the files are stored
+    :type folder:
+        String
+    :param max_size:
+        The size budget in bytes
+    :type max_size:
+        int
+    :param suffix:
+        The extension of the files, e.g. '.TIF'
+    :type suffix:
+        String
+    """
+
+    def __init__(self, folder, max_size, suffix=''):
+        self.folder = folder
+        self.max_size = max_size
+        self.suffix = suffix
+
+    def path(self, key):
+        """ Returns the path of the file that stores the key """
+        return join(self.folder, fingerprint(key) + self.suffix)
+
+    def lock(self, key):
+        """ Returns a context manager that holds the lock of the key, e.g. while its file is
+        written, so processes that need the same file wait for it instead of writing it again.
+        Entries that are locked are not evicted.
+
+        :param key:
+            Any JSON serializable value
+        :type key:
+            Any
+        """
+        check_create_folder(self.folder)
+
+        return file_lock(self.path(key) + '.lock')
+
+    def get(self, key):
+        """ Returns the path of the file stored for the key, or None if there is none.
+
+        :param key:
+            Any JSON serializable value
+        :type key:
+            Any
+
+        :returns:
+            String
+        """
+        path = self.path(key)
+
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            return None
+
+        return path
+
+    def add(self, key, write):
+        """ Stores a file for the key and evicts the least recently used files if the cache is
+        over its budget.
+
+        :param key:
+            Any JSON serializable value
+        :type key:
+            Any
+        :param write:
+            A function that writes the file to the path it is given
+        :type write:
+            Function
+
+        :returns:
+            (String) the path of the stored file
+        """
+        check_create_folder(self.folder)
+
+        handle, temp = tempfile.mkstemp(suffix='.tmp' + self.suffix, dir=self.folder)
+        os.close(handle)
+
+        try:
+            write(temp)
+            os.rename(temp, self.path(key))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+        self.evict(keep=self.path(key))
+
+        return self.path(key)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used files until the cache is within its budget.
+
+        :param keep:
+            Path of a file that must not be removed (optional)
+        :type keep:
+            String
+        """
+        entries = []
+        for name in os.listdir(self.folder):
+            path = join(self.folder, name)
+            # Files being written and lock files are not entries
+            if (not name.endswith(self.suffix) or name.endswith(('.lock', '.tmp' + self.suffix)) or
+                    path == keep):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        if keep and os.path.exists(keep):
+            size += os.path.getsize(keep)
+
+        for atime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            if os.path.exists(path + '.lock'):
+                with file_lock(path + '.lock', blocking=False) as acquired:
+                    if acquired:
+                        size -= self._remove(path, entry_size)
+            else:
+                size -= self._remove(path, entry_size)
+
+    def _remove(self, path, size):
+        """ Removes an entry and returns the number of bytes freed """
+        try:
+            os.remove(path)
+        except OSError:
+            return 0
+        return size
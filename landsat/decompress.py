@@ -0,0 +1,195 @@
+# Parallel bzip2 decompression
+# Landsat Util
+# License: CC0 1.0 Universal
+
+from __future__ import print_function, division, absolute_import
+
+import io
+import bz2
+import mmap
+import binascii
+import multiprocessing
+from bisect import bisect_right
+from collections import deque
+
+# A bzip2 stream is made of blocks that are compressed independently. Each block starts with
+# BLOCK_MAGIC followed by the 32 bit CRC of the block, and the stream ends with EOS_MAGIC followed
+# by the combined CRC of the blocks. The markers are not byte aligned.
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+CRC_BITS = 32
+
+
+def _to_int(chunk):
+    """ Converts big-endian bytes to an integer """
+    return int(binascii.hexlify(chunk), 16) if chunk else 0
+
+
+def _to_bytes(value, length):
+    """ Converts an integer to length big-endian bytes """
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def _read_bits(data, start, count):
+    """ Returns count bits of data starting at bit start as an integer, or None past the end of data """
+    first = start // 8
+    last = (start + count + 7) // 8
+
+    if last > len(data):
+        return None
+
+    value = _to_int(data[first:last])
+    value >>= (last - first) * 8 - (start - first * 8) - count
+
+    return value & ((1 << count) - 1)
+
+
+def _find_magic(data, magic):
+    """ Returns the bit positions of a 48 bit marker in data.
+
+    For each of the 8 possible bit offsets the bytes that are fully covered by the shifted
+    marker are searched for, and the partial bytes around them are then verified.
+    """
+    positions = []
+
+    for shift in range(8):
+        length = (shift + MAGIC_BITS + 7) // 8
+        pattern = _to_bytes(magic << (length * 8 - shift - MAGIC_BITS), length)
+        first = 1 if shift else 0
+        last = length - 1 if (shift + MAGIC_BITS) % 8 else length
+
+        index = data.find(pattern[first:last])
+        while index != -1:
+            bit = (index - first) * 8 + shift
+            if bit >= 0 and _read_bits(data, bit, MAGIC_BITS) == magic:
+                positions.append(bit)
+            index = data.find(pattern[first:last], index + 1)
+
+    return sorted(positions)
+
+
+def find_blocks(data):
+    """ Finds the compressed blocks of bzip2 data. Concatenated streams are supported.
+
+    :param data:
+        The compressed data
+    :type data:
+        bytes or mmap
+
+    :returns:
+        (List) the start and end bit positions of each block
+    """
+    starts = _find_magic(data, BLOCK_MAGIC)
+    ends = sorted(starts + _find_magic(data, EOS_MAGIC))
+
+    blocks = []
+    for start in starts:
+        index = bisect_right(ends, start)
+        if index == len(ends):
+            raise ValueError('bzip2 block at bit %s has no end' % start)
+        blocks.append((start, ends[index]))
+
+    return blocks
+
+
+def decompress_block(task):
+    """ Decompresses a single block by wrapping it in a bzip2 stream of its own.
+
+    :param task:
+        The bytes that contain the block, the bit offset of the block in the first byte
+        and the length of the block in bits
+    :type task:
+        Tuple
+
+    :returns:
+        bytes
+    """
+    chunk, offset, length = task
+
+    block = _read_bits(chunk, offset, length)
+
+    # The combined CRC of a stream with a single block is the CRC of that block
+    crc = (block >> (length - MAGIC_BITS - CRC_BITS)) & ((1 << CRC_BITS) - 1)
+
+    stream = (((block << MAGIC_BITS) | EOS_MAGIC) << CRC_BITS) | crc
+    length += MAGIC_BITS + CRC_BITS
+    padding = -length % 8
+
+    return bz2.decompress(b'BZh9' + _to_bytes(stream << padding, (length + padding) // 8))
+
+
+class ParallelBZ2File(io.RawIOBase):
+    """
+    Read-only file object that decompresses a bzip2 file with a pool of processes.
+
+    The blocks are decompressed concurrently and returned in order, with a bounded number of
+    decompressed blocks held in memory.
+
+    :param path:
+        Path to the bzip2 file
+    :type path:
+        String
+    :param processes:
+        Number of processes. Defaults to the number of cpus.
+    :type processes:
+        int
+    """
+
+    def __init__(self, path, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._file = open(path, 'rb')
+        self._data = None
+        self._pool = None
+
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._blocks = find_blocks(self._data)
+        except (ValueError, mmap.error):
+            self.close()
+            raise IOError('%s is not a bzip2 file that can be decompressed in parallel' % path)
+
+        if not self._blocks:
+            self.close()
+            raise IOError('%s has no bzip2 blocks' % path)
+
+        self._pool = multiprocessing.Pool(self.processes)
+        self._pending = deque()
+        self._next = 0
+        self._buffer = memoryview(b'')
+
+    def _task(self, index):
+        start, end = self._blocks[index]
+        return self._data[start // 8:(end + 7) // 8], start % 8, end - start
+
+    def _fill(self):
+        while len(self._pending) < self.processes * 2 and self._next < len(self._blocks):
+            self._pending.append(self._pool.apply_async(decompress_block, (self._task(self._next),)))
+            self._next += 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._buffer):
+            self._fill()
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().get())
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+
+        return size
+
+    def close(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        self._file.close()
+        super(ParallelBZ2File, self).close()
@@ -11,3 +11,14 @@ def rasterio_decorator(func):
                 return func(*args, **kwargs)
 
     return wrapped_f
+
+
+def scratch_decorator(func):
+    """ Removes the memory mapped files of an image process once it is done """
+    def wrapped_f(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._cleanup_scratch()
+
+    return wrapped_f
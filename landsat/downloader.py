@@ -3,13 +3,18 @@
 
 from __future__ import print_function, division, absolute_import
 
+import os
+import math
+import threading
+from multiprocessing import pool
 from xml.etree import ElementTree
 from os.path import join, exists, getsize
 
 import requests
+from requests.adapters import HTTPAdapter
 from usgs import api, USGSError
-from homura import download as fetch
 
+from .cache import FileCache, link, read_json, write_json
 from .utils import check_create_folder, url_builder
 from .mixins import VerbosityMixin
 from . import settings
@@ -30,15 +35,297 @@ class USGSInventoryAccessMissing(Exception):
     pass
 
 
+class IncompleteDownload(Exception):
+    """ Exception to be used when the downloaded file does not have the size of the remote file """
+    pass
+
+
+class RemoteFileChanged(IncompleteDownload):
+    """ Exception to be used when the remote file changed since it was probed """
+    pass
+
+
+def segment_ranges(size, segment_size=None, max_segments=None):
+    """ Splits a file into byte ranges of at least segment_size bytes, at most max_segments of them.
+
+    :param size:
+        The size of the file in bytes
+    :type size:
+        int
+    :param segment_size:
+        Minimum size of a range. Default is settings.DOWNLOAD_SEGMENT_SIZE
+    :type segment_size:
+        int
+    :param max_segments:
+        Maximum number of ranges. Default is settings.DOWNLOAD_SEGMENTS
+    :type max_segments:
+        int
+
+    :returns:
+        (List) the first and last byte of each range
+
+    :example:
+        >>> segment_ranges(10, 4, 8)
+        [(0, 4), (5, 9)]
+    """
+    segment_size = segment_size or settings.DOWNLOAD_SEGMENT_SIZE
+    max_segments = max_segments or settings.DOWNLOAD_SEGMENTS
+
+    count = max(1, min(max_segments, size // segment_size))
+    step = int(math.ceil(size / count))
+
+    if count == 1:
+        return [(0, size - 1)]
+
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def fetch(url, path, session=None, size=None, validator=None, chunk_size=1024 * 1024, segments=None, limit=None):
+    """ Downloads the given url to path, resuming a previous attempt if there is one.
+
+    The data is written to path + '.part', which is renamed to path once it is complete. If the
+    part file exists, only the missing bytes are requested with an HTTP Range. The validator, the
+    ETag or Last-Modified of the remote file, makes the server send the whole file instead if it
+    changed since the part file was started.
+
+    With more than one segment, the ranges are downloaded at the same time instead, see
+    fetch_segments.
+
+    :param url:
+        The url to be downloaded.
+    :type url:
+        String
+    :param path:
+        The path of the downloaded file
+    :type path:
+        String
+    :param session:
+        The session used for the request. Default is a new connection
+    :type session:
+        requests.Session
+    :param size:
+        The size of the remote file, if known
+    :type size:
+        int
+    :param validator:
+        The ETag or Last-Modified of the remote file, if known
+    :type validator:
+        String
+    :param chunk_size:
+        Number of bytes read and written at a time
+    :type chunk_size:
+        int
+    :param segments:
+        The byte ranges to download in parallel, as returned by segment_ranges. (optional)
+    :type segments:
+        List
+    :param limit:
+        Semaphore acquired for the transfer of each segment. (optional)
+    :type limit:
+        threading.Semaphore
+
+    :returns:
+        (String) the path of the downloaded file
+
+    :raises IncompleteDownload:
+        If the connection was closed before the end of the file. The part file is kept so the
+        next attempt resumes it.
+    """
+    session = session or requests
+
+    if segments and len(segments) > 1:
+        return fetch_segments(url, path, session, segments, validator, chunk_size, limit)
+
+    part = path + '.part'
+    offset = getsize(part) if exists(part) else 0
+
+    if size is not None and offset > size:
+        os.remove(part)
+        offset = 0
+
+    if size is None or offset < size:
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%s-' % offset
+            if validator:
+                headers['If-Range'] = validator
+
+        response = session.get(url, headers=headers, stream=True, timeout=settings.DOWNLOAD_TIMEOUT)
+        try:
+            if response.status_code == 416:
+                # The part file does not match the remote file anymore, start over
+                os.remove(part)
+                raise IncompleteDownload('%s: the download has to start over' % url)
+
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                expected = int(response.headers['content-range'].rsplit('/', 1)[-1])
+                mode = 'ab'
+            else:
+                # The server sent the whole file
+                length = response.headers.get('content-length')
+                expected = int(length) if length is not None else size
+                mode = 'wb'
+
+            with open(part, mode) as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        if expected is not None and getsize(part) != expected:
+            raise IncompleteDownload('%s: %s of %s bytes received' % (url, getsize(part), expected))
+
+    os.rename(part, path)
+    return path
+
+
+def fetch_segments(url, path, session, segments, validator=None, chunk_size=1024 * 1024, limit=None):
+    """ Downloads the byte ranges of the given url at the same time into a preallocated file.
+
+    The data is written to path + '.segments', and the ranges already downloaded are recorded in
+    path + '.segments.json', so a later attempt only downloads the missing ones. The file is renamed
+    to path once every range has been received in full.
+
+    :param url:
+        The url to be downloaded.
+    :type url:
+        String
+    :param path:
+        The path of the downloaded file
+    :type path:
+        String
+    :param session:
+        The session used for the requests
+    :type session:
+        requests.Session
+    :param segments:
+        The byte ranges to download, as returned by segment_ranges
+    :type segments:
+        List
+    :param validator:
+        The ETag or Last-Modified of the remote file, if known. A range is rejected if the remote
+        file changed.
+    :type validator:
+        String
+    :param chunk_size:
+        Number of bytes read and written at a time
+    :type chunk_size:
+        int
+    :param limit:
+        Semaphore acquired for the transfer of each segment. (optional)
+    :type limit:
+        threading.Semaphore
+
+    :returns:
+        (String) the path of the downloaded file
+
+    :raises IncompleteDownload:
+        If a range was not received in full
+    :raises RemoteFileChanged:
+        If the remote file changed, i.e. the server did not send a range for the validator
+    """
+    segments = [list(segment) for segment in segments]
+    size = segments[-1][1] + 1
+    part = path + '.segments'
+    state_path = part + '.json'
+
+    state = read_json(state_path) or {}
+    if (state.get('segments') != segments or state.get('validator') != validator or
+            not exists(part) or getsize(part) != size):
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        state = write_json(state_path, {'segments': segments, 'validator': validator, 'done': []})
+
+    lock = threading.Lock()
+    changed = []
+
+    def download(i):
+        start, end = segments[i]
+        headers = {'Range': 'bytes=%s-%s' % (start, end)}
+        if validator:
+            headers['If-Range'] = validator
+
+        if limit:
+            limit.acquire()
+        try:
+            response = session.get(url, headers=headers, stream=True, timeout=settings.DOWNLOAD_TIMEOUT)
+            try:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    changed.append(i)
+                    raise RemoteFileChanged('%s changed since the download started' % url)
+
+                received = 0
+                with open(part, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        received += len(chunk)
+            finally:
+                response.close()
+        finally:
+            if limit:
+                limit.release()
+
+        if received != end - start + 1:
+            raise IncompleteDownload('%s: %s of %s bytes of range %s received' % (url, received, end - start + 1, i))
+
+        with lock:
+            state['done'].append(i)
+            write_json(state_path, state)
+
+    pending = [i for i in range(len(segments)) if i not in state['done']]
+    if pending:
+        tpool = pool.ThreadPool(processes=len(pending))
+        try:
+            tpool.map(download, pending)
+        finally:
+            tpool.close()
+            tpool.join()
+            if changed:
+                os.remove(state_path)
+
+    os.rename(part, path)
+    os.remove(state_path)
+    return path
+
+
 class Downloader(VerbosityMixin):
-    """ The downloader class """
+    """ The downloader class
+
+    Scenes, and the bands of a scene, are downloaded by up to `threads` threads at the same time.
+    The number of concurrent transfers from each source is also capped by settings.DOWNLOAD_LIMITS.
 
-    def __init__(self, verbose=False, download_dir=None, usgs_user=None, usgs_pass=None):
+    Requests go through one session, so connections are reused, and each url is probed once: its
+    status, size, ETag and Last-Modified are kept for the life of the downloader.
+
+    With cache, files are downloaded once per host into settings.DOWNLOAD_CACHE, keyed by url and
+    ETag, and hard linked into download_dir. Processes that need a file being downloaded wait
+    for it. The least recently used files are evicted beyond settings.DOWNLOAD_CACHE_SIZE.
+    """
+
+    def __init__(self, verbose=False, download_dir=None, usgs_user=None, usgs_pass=None, threads=1,
+                 cache=False):
         self.download_dir = download_dir if download_dir else settings.DOWNLOAD_DIR
         self.google = settings.GOOGLE_STORAGE
         self.s3 = settings.S3_LANDSAT
         self.usgs_user = usgs_user
         self.usgs_pass = usgs_pass
+        self.threads = threads
+        self.limits = dict((source, threading.BoundedSemaphore(limit))
+                           for source, limit in settings.DOWNLOAD_LIMITS.items())
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(threads, max(settings.DOWNLOAD_LIMITS.values())))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.probes = {}
+        self._probe_lock = threading.Lock()
+
+        self.cache = FileCache(settings.DOWNLOAD_CACHE, settings.DOWNLOAD_CACHE_SIZE, '.download') if cache else None
 
         # Make sure download directory exist
         check_create_folder(self.download_dir)
@@ -61,28 +348,51 @@ class Downloader(VerbosityMixin):
         """
 
         if isinstance(scenes, list):
-            files = []
+            return self._map(lambda scene: self._download_scene(scene, bands), scenes)
 
-            for scene in scenes:
+        else:
+            raise Exception('Expected sceneIDs list')
 
-                # for all scenes if bands provided, first check AWS, if the bands exist
-                # download them, otherwise use Google and then USGS.
-                try:
-                    # if bands are not provided, directly go to Goodle and then USGS
-                    if not isinstance(bands, list):
-                        raise RemoteFileDoesntExist
-                    files.append(self.amazon_s3(scene, bands))
+    def _download_scene(self, scene, bands):
+        """ Downloads one scene from the first source that has it """
 
-                except RemoteFileDoesntExist:
-                    try:
-                        files.append(self.google_storage(scene, self.download_dir))
-                    except RemoteFileDoesntExist:
-                        files.append(self.usgs_eros(scene, self.download_dir))
+        # for all scenes if bands provided, first check AWS, if the bands exist
+        # download them, otherwise use Google and then USGS.
+        try:
+            # if bands are not provided, directly go to Goodle and then USGS
+            if not isinstance(bands, list):
+                raise RemoteFileDoesntExist
+            return self.amazon_s3(scene, bands)
 
-            return files
+        except RemoteFileDoesntExist:
+            try:
+                return self.google_storage(scene, self.download_dir)
+            except RemoteFileDoesntExist:
+                return self.usgs_eros(scene, self.download_dir)
 
-        else:
-            raise Exception('Expected sceneIDs list')
+    def _map(self, func, items):
+        """ Calls func on every item, concurrently if more than one thread is allowed, and returns
+        the results in the order of the items.
+        """
+        items = list(items)
+
+        if self.threads > 1 and len(items) > 1:
+            tpool = pool.ThreadPool(processes=min(self.threads, len(items)))
+            try:
+                return tpool.map(func, items)
+            finally:
+                tpool.close()
+                tpool.join()
+
+        return [func(item) for item in items]
+
+    def _source(self, url):
+        """ Name of the source of the url in settings.DOWNLOAD_LIMITS """
+        if url.startswith(self.s3):
+            return 's3'
+        if url.startswith(self.google):
+            return 'google'
+        return 'usgs'
 
     def usgs_eros(self, scene, path):
         """ Downloads the image from USGS """
@@ -136,6 +446,9 @@ class Downloader(VerbosityMixin):
 
         sat = self.scene_interpreter(scene)
 
+        # The list is shared by the scenes downloaded at the same time
+        bands = list(bands)
+
         # Always grab MTL.txt and QA band if bands are specified
         if 'BQA' not in bands:
             bands.append('QA')
@@ -143,22 +456,16 @@ class Downloader(VerbosityMixin):
         if 'MTL' not in bands:
             bands.append('MTL')
 
-        urls = []
-
-        for band in bands:
-            # get url for the band
-            url = self.amazon_s3_url(sat, band)
+        urls = [self.amazon_s3_url(sat, band) for band in bands]
 
-            # make sure it exist
-            self.remote_file_exists(url)
-            urls.append(url)
+        # make sure they exist
+        self._map(self.remote_file_exists, urls)
 
         # create folder
         path = check_create_folder(join(self.download_dir, scene))
 
         self.output('Source: AWS S3', normal=True, arrow=True)
-        for url in urls:
-            self.fetch(url, path)
+        self._map(lambda url: self.fetch(url, path), urls)
 
         return path
 
@@ -179,7 +486,7 @@ class Downloader(VerbosityMixin):
             String
 
         :returns:
-            Boolean
+            (String) the path of the downloaded file
         """
 
         segments = url.split('/')
@@ -190,19 +497,73 @@ class Downloader(VerbosityMixin):
 
         self.output('Downloading: %s' % filename, normal=True, arrow=True)
 
-        # print(join(path, filename))
-        # raise Exception
-        if exists(join(path, filename)):
-            size = getsize(join(path, filename))
-            if size == self.get_remote_file_size(url):
-                self.output('%s already exists on your system' % filename, normal=True, color='green', indent=1)
+        target = join(path, filename)
+        remote = self.probe(url)
+        validator = remote['etag'] or remote['last_modified']
+
+        if exists(target) and getsize(target) == remote['size']:
+            self.output('%s already exists on your system' % filename, normal=True, color='green', indent=1)
+
+        elif self.cache and validator:
+            key = [url, validator, remote['size']]
+
+            with self.cache.lock(key):
+                cached = self.cache.get(key)
+                if cached:
+                    self.output('%s found in the download cache' % filename, normal=True, color='green', indent=1)
+                else:
+                    cached = self._download(url, self.cache.path(key), remote, filename)
+                    self.cache.evict(keep=cached)
+
+                if exists(target):
+                    os.remove(target)
+                link(cached, target)
 
         else:
-            fetch(url, path)
+            if exists(target):
+                # Left by an interrupted download, resume it
+                if remote['size'] and getsize(target) < remote['size'] and not exists(target + '.part'):
+                    os.rename(target, target + '.part')
+                else:
+                    os.remove(target)
+
+            self._download(url, target, remote, filename)
+
         self.output('stored at %s' % path, normal=True, color='green', indent=1)
 
         return join(path, filename)
 
+    def _download(self, url, target, remote, filename):
+        """ Downloads url to target, resuming after interruptions, and returns target """
+        limit = self.limits[self._source(url)]
+
+        for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+            validator = remote['etag'] or remote['last_modified']
+            segments = segment_ranges(remote['size']) if remote['size'] and remote['ranges'] else None
+
+            try:
+                if segments and len(segments) > 1:
+                    fetch(url, target, self.session, remote['size'], validator, segments=segments, limit=limit)
+                else:
+                    with limit:
+                        fetch(url, target, self.session, remote['size'], validator)
+                break
+            except RemoteFileChanged:
+                if attempt == settings.DOWNLOAD_RETRIES:
+                    raise
+                self.output('%s changed on the server, starting over' % filename, normal=True, color='red', indent=1)
+
+                with self._probe_lock:
+                    self.probes.pop(url, None)
+                remote = self.probe(url)
+            except (IncompleteDownload, requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                if attempt == settings.DOWNLOAD_RETRIES:
+                    raise
+                self.output('Download of %s interrupted, resuming' % filename, normal=True, color='red', indent=1)
+
+        return target
+
     def google_storage_url(self, sat):
         """
         Returns a google storage url the contains the scene provided.
@@ -241,6 +602,38 @@ class Downloader(VerbosityMixin):
 
         return url_builder([self.s3, sat['sat'], sat['path'], sat['row'], sat['scene'], filename])
 
+    def probe(self, url):
+        """ Returns the metadata of a remote file. The url is only requested the first time.
+
+        :param url:
+            The url that has to be checked.
+        :type url:
+            String
+
+        :returns:
+            (Dictionary) the status code, size in bytes, etag and last_modified of the file, and
+            whether the server accepts byte ranges. Size, etag and last_modified are None when the
+            server does not report them.
+        """
+        with self._probe_lock:
+            if url in self.probes:
+                return self.probes[url]
+
+        response = self.session.head(url, allow_redirects=True, timeout=settings.DOWNLOAD_TIMEOUT)
+        headers = response.headers
+        size = headers.get('content-length')
+
+        metadata = {
+            'status': response.status_code,
+            'size': int(size) if size is not None else None,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'ranges': headers.get('accept-ranges') == 'bytes'
+        }
+
+        with self._probe_lock:
+            return self.probes.setdefault(url, metadata)
+
     def remote_file_exists(self, url):
         """ Checks whether the remote file exists.
 
@@ -252,7 +645,7 @@ class Downloader(VerbosityMixin):
         :returns:
             **True** if remote file exists and **False** if it doesn't exist.
         """
-        status = requests.head(url).status_code
+        status = self.probe(url)['status']
 
         if status != 200:
             raise RemoteFileDoesntExist
@@ -268,8 +661,7 @@ class Downloader(VerbosityMixin):
         :returns:
             int
         """
-        headers = requests.head(url).headers
-        return int(headers['content-length'])
+        return self.probe(url)['size']
 
     def scene_interpreter(self, scene):
         """ Conver sceneID to rows, paths and dates.
@@ -4,12 +4,16 @@
 
 from __future__ import print_function, division, absolute_import
 
+import io
 import os
 import tarfile
 import glob
+import tempfile
 from copy import copy
 import subprocess
-from shutil import copyfile
+import multiprocessing
+from multiprocessing import pool
+from shutil import copyfile, copyfileobj, rmtree
 from os.path import join, isdir
 
 import numpy
@@ -17,14 +21,18 @@ import rasterio
 from rasterio.coords import disjoint_bounds
 from rasterio.warp import reproject, RESAMPLING, transform, transform_bounds
 
-from skimage import transform as sktransform
 from skimage.util import img_as_ubyte
 from skimage.exposure import rescale_intensity
 from polyline.codec import PolylineCodec
 
+from . import settings
+from .cache import FileCache, JSONCache, fingerprint, link, read_json, write_json
+from .metadata import Metadata, read_metadata
 from .mixins import VerbosityMixin
-from .utils import get_file, check_create_folder, exit, adjust_bounding_box
-from .decorators import rasterio_decorator
+from .stats import Histogram
+from .decompress import ParallelBZ2File
+from .utils import get_file, get_filename, check_create_folder, exit, adjust_bounding_box
+from .decorators import rasterio_decorator, scratch_decorator
 
 
 class FileDoesNotExist(Exception):
@@ -63,16 +71,88 @@ class BaseProcess(VerbosityMixin):
         Whether to force unzip the tar file. Default is False
     :type force_unzip:
         boolean
+    :param block_size:
+        If provided, the image is reprojected, color corrected and written in blocks of
+        block_size x block_size pixels, so memory usage depends on the block size rather than
+        the scene size. Default is None (the whole scene is processed at once)
+    :type block_size:
+        int
+    :param threads:
+        The number of threads used to reproject the bands concurrently. Default is 1
+    :type threads:
+        int
+    :param selective_unzip:
+        Whether to only extract the bands that are processed, the QA band and the MTL file
+        from the tar file. Default is False
+    :type selective_unzip:
+        boolean
+    :param unzip_processes:
+        The number of processes used to decompress bzip2 tar files. Default is 1
+    :type unzip_processes:
+        int
+    :param scratch_dir:
+        If provided, the intermediate bands are stored in memory mapped files in this folder
+        instead of memory. The files are removed when processing ends. (optional)
+    :type scratch_dir:
+        String
+    :param grid_cache:
+        Whether to cache the destination grid of the scene in settings.GRID_CACHE, so it is
+        not recalculated for other scenes of the same path/row. Default is False
+    :type grid_cache:
+        boolean
+    :param output_profile:
+        The name of the settings.OUTPUT_PROFILES entry used to write the image, e.g. 'cog' for a
+        tiled, compressed image with overviews. Default is 'default' (uncompressed)
+    :type output_profile:
+        String
+    :param qa_decimation:
+        If above one, the cloud and snow coverage is calculated from a decimated read of the QA band
+        that keeps one of qa_decimation x qa_decimation pixels. Default is 1 (every pixel)
+    :type qa_decimation:
+        int
+    :param toa:
+        Whether to convert the DNs of the bands to top of atmosphere reflectance corrected for the sun
+        elevation, using the coefficients of the MTL file, before NDVI or color correction. Default is False
+    :type toa:
+        boolean
+    :param virtual_clip:
+        Whether to clip the image by only reading the window of the bands that covers the bounds,
+        instead of writing clipped copies of the bands to a clipped folder. Default is False
+    :type virtual_clip:
+        boolean
+    :param clip_cache:
+        Whether to keep the clipped bands in settings.CLIP_CACHE, so clipping the scene to the same
+        bounds again reuses them. Default is False
+    :type clip_cache:
+        boolean
 
     """
 
-    def __init__(self, path, bands=None, dst_path=None, verbose=False, force_unzip=False, bounds=None):
+    # uint16 bands store the reflectance multiplied by this value
+    reflectance_scale = 50000
+
+    def __init__(self, path, bands=None, dst_path=None, verbose=False, force_unzip=False, bounds=None,
+                 block_size=None, threads=1, selective_unzip=False, unzip_processes=1, scratch_dir=None,
+                 grid_cache=False, output_profile='default', qa_decimation=1, toa=False, virtual_clip=False,
+                 clip_cache=False):
 
         self.projection = {'init': 'epsg:3857'}
         self.dst_crs = {'init': u'epsg:3857'}
         self.scene = get_file(path).split('.')[0]
         self.bands = bands if isinstance(bands, list) else [4, 3, 2]
         self.clipped = False
+        self.block_size = block_size
+        self.threads = threads if threads and threads > 1 else 1
+        self.selective_unzip = selective_unzip
+        self.unzip_processes = unzip_processes if unzip_processes and unzip_processes > 1 else 1
+        self.scratch_dir = scratch_dir
+        self.scratch_path = None
+        self.grid_cache = grid_cache
+        self.output_profile = settings.OUTPUT_PROFILES[output_profile]
+        self.qa_decimation = qa_decimation if qa_decimation and qa_decimation > 1 else 1
+        self.toa = toa
+        self.windows = {}
+        self.clip_cache = clip_cache
 
         # Landsat source path
         self.src_path = path.replace(get_file(path), '')
@@ -91,7 +171,10 @@ class BaseProcess(VerbosityMixin):
 
         if (bounds):
             self.bounds = bounds
-            self.scene_path = self.clip()
+            if virtual_clip:
+                self.windows = self._clip_windows()
+            else:
+                self.scene_path = self.clip()
             self.clipped = True
 
         self.bands_path = []
@@ -101,38 +184,18 @@ class BaseProcess(VerbosityMixin):
     def _get_boundaries(self, src, shape):
 
         self.output("Getting boundaries", normal=True, arrow=True)
-        output = {'ul': {'x': [0, 0], 'y': [0, 0]},  # ul: upper left
-                  'ur': {'x': [0, 0], 'y': [0, 0]},  # ur: upper right
-                  'll': {'x': [0, 0], 'y': [0, 0]},  # ll: lower left
-                  'lr': {'x': [0, 0], 'y': [0, 0]}}  # lr: lower right
-
-        output['ul']['x'][0] = src['affine'][2]
-        output['ul']['y'][0] = src['affine'][5]
-        output['ur']['x'][0] = output['ul']['x'][0] + self.pixel * src['shape'][1]
-        output['ur']['y'][0] = output['ul']['y'][0]
-        output['ll']['x'][0] = output['ul']['x'][0]
-        output['ll']['y'][0] = output['ul']['y'][0] - self.pixel * src['shape'][0]
-        output['lr']['x'][0] = output['ul']['x'][0] + self.pixel * src['shape'][1]
-        output['lr']['y'][0] = output['ul']['y'][0] - self.pixel * src['shape'][0]
-
-        output['ul']['x'][1], output['ul']['y'][1] = transform(src['crs'], self.projection,
-                                                               [output['ul']['x'][0]],
-                                                               [output['ul']['y'][0]])
-
-        output['ur']['x'][1], output['ur']['y'][1] = transform(src['crs'], self.projection,
-                                                               [output['ur']['x'][0]],
-                                                               [output['ur']['y'][0]])
-
-        output['ll']['x'][1], output['ll']['y'][1] = transform(src['crs'], self.projection,
-                                                               [output['ll']['x'][0]],
-                                                               [output['ll']['y'][0]])
-
-        output['lr']['x'][1], output['lr']['y'][1] = transform(src['crs'], self.projection,
-                                                               [output['lr']['x'][0]],
-                                                               [output['lr']['y'][0]])
-
-        dst_corner_ys = [output[k]['y'][1][0] for k in output.keys()]
-        dst_corner_xs = [output[k]['x'][1][0] for k in output.keys()]
+
+        # Corners of the source image: upper left, upper right, lower left, lower right
+        ul_x = src['affine'][2]
+        ul_y = src['affine'][5]
+        lr_x = ul_x + self.pixel * src['shape'][1]
+        lr_y = ul_y - self.pixel * src['shape'][0]
+
+        # Project the four corners in one call
+        dst_corner_xs, dst_corner_ys = transform(src['crs'], self.projection,
+                                                 [ul_x, lr_x, ul_x, lr_x],
+                                                 [ul_y, ul_y, lr_y, lr_y])
+
         y_pixel = abs(max(dst_corner_ys) - min(dst_corner_ys)) / shape[0]
         x_pixel = abs(max(dst_corner_xs) - min(dst_corner_xs)) / shape[1]
 
@@ -144,37 +207,261 @@ class BaseProcess(VerbosityMixin):
 
         try:
             for i, band in enumerate(self.bands):
-                bands.append(rasterio.open(self.bands_path[i]).read_band(1))
+                bands.append(rasterio.open(self.bands_path[i]).read_band(1, window=self.windows.get(band)))
         except IOError as e:
             exit(e.message, 1)
 
         return bands
 
+    def _open_bands(self):
+        """ Opens the bands with rasterio without reading them """
+        srcs = []
+
+        try:
+            for i, band in enumerate(self.bands):
+                srcs.append(rasterio.open(self.bands_path[i]))
+        except IOError as e:
+            exit(e.message, 1)
+
+        return srcs
+
+    def _block_windows(self, shape):
+        """ Yields the windows of block_size x block_size pixels that cover an image of the given shape """
+        for row in range(0, shape[0], self.block_size):
+            for col in range(0, shape[1], self.block_size):
+                yield ((row, min(row + self.block_size, shape[0])),
+                       (col, min(col + self.block_size, shape[1])))
+
+    def _window_transform(self, dst_transform, window):
+        """ Returns the geotransform of a window of the destination image """
+        return (dst_transform[0] + window[1][0] * dst_transform[1], dst_transform[1], dst_transform[2],
+                dst_transform[3] + window[0][0] * dst_transform[5], dst_transform[4], dst_transform[5])
+
+    def _resampling(self, index):
+        """ Resampling method used when a band is reprojected block by block """
+        return RESAMPLING.nearest
+
+    def _map(self, func, items):
+        """ Calls func on every item, concurrently if more than one thread is allowed.
+
+        The heavy lifting (GDAL warping, numpy operations) releases the GIL, so threads
+        are enough to keep several cores busy.
+        """
+        items = list(items)
+
+        if self.threads > 1 and len(items) > 1:
+            tpool = pool.ThreadPool(processes=min(self.threads, len(items)))
+            try:
+                return tpool.map(func, items)
+            finally:
+                tpool.close()
+                tpool.join()
+
+        return [func(item) for item in items]
+
+    def _warp_threads(self, count):
+        """ Number of GDAL warp threads used for each of the count bands reprojected at the same time """
+        if self.threads > 1:
+            return max(1, self.threads // count)
+        return 2
+
+    def _warp_block(self, proj_data, srcs, window, dtype=numpy.uint16):
+        """ Reprojects the part of each band that falls in the given window of the destination image.
+        Only the source pixels needed for the window are read from disk.
+        """
+        shape = (window[0][1] - window[0][0], window[1][1] - window[1][0])
+        dst_transform = self._window_transform(proj_data['dst_transform'], window)
+        num_threads = self._warp_threads(len(srcs))
+
+        def warp_band(i):
+            block = numpy.zeros(shape, dtype=dtype)
+            reproject(rasterio.band(srcs[i], 1), block, dst_transform=dst_transform, dst_crs=self.dst_crs,
+                      resampling=self._resampling(i), num_threads=num_threads)
+            return block
+
+        blocks = self._map(warp_band, range(len(srcs)))
+
+        if self.toa:
+            self._to_reflectance(blocks)
+
+        return blocks
+
     def _warp(self, proj_data, bands, new_bands):
         self.output("Projecting", normal=True, arrow=True)
-        for i, band in enumerate(bands):
+        num_threads = self._warp_threads(len(bands))
+
+        def warp_band(i):
             self.output("band %s" % self.bands[i], normal=True, color='green', indent=1)
-            reproject(band, new_bands[i], src_transform=proj_data['transform'], src_crs=proj_data['crs'],
+            reproject(bands[i], new_bands[i], src_transform=proj_data['transform'], src_crs=proj_data['crs'],
                       dst_transform=proj_data['dst_transform'], dst_crs=self.dst_crs, resampling=RESAMPLING.nearest,
-                      num_threads=2)
+                      num_threads=num_threads)
+
+        self._map(warp_band, range(len(bands)))
+
+        if self.toa:
+            self.output("Converting to reflectance", normal=True, arrow=True)
+            self._to_reflectance(new_bands)
+
+    def _reflectance_factors(self):
+        """ Returns for each band the factors that convert its DNs to top of atmosphere reflectance
+        corrected for the sun elevation: (DN * mult + add) / sin(sun elevation)
+        """
+        metadata = self._read_metadata()
+
+        if not metadata.sun_elevation:
+            exit('The sun elevation is missing from the MTL file', 1)
+
+        sun = numpy.sin(numpy.radians(metadata.sun_elevation))
+
+        factors = []
+        for band in self.bands:
+            reflectance = metadata.reflectance(band)
+            if reflectance is None:
+                exit('The reflectance coefficients of band %s are missing from the MTL file' % band, 1)
+            factors.append((reflectance[0] / sun, reflectance[1] / sun))
+
+        return factors
+
+    def _to_reflectance(self, bands, rows=256):
+        """ Converts the DNs of the bands, or of blocks of them, to top of atmosphere reflectance in place.
+
+        float32 bands receive the reflectance. uint16 bands receive the reflectance multiplied by
+        reflectance_scale, so they can be color corrected like DNs. Nodata (0) and saturated (65535) pixels
+        are kept as they are. The bands are converted concurrently, rows at a time.
+
+        :param bands:
+            The bands, in the order of self.bands
+        :type bands:
+            List
+
+        :returns:
+            The bands
+        """
+        factors = self._reflectance_factors()
+
+        def convert(i):
+            band = bands[i]
+            mult, add = factors[i]
+            buf = numpy.empty((min(rows, band.shape[0]), band.shape[1]), dtype=numpy.float32)
+
+            for top in range(0, band.shape[0], rows):
+                dn = band[top:top + rows]
+                out = dn if band.dtype == numpy.float32 else buf[:dn.shape[0]]
+                keep = dn == 0 if band.dtype == numpy.float32 else numpy.logical_or(dn == 0, dn == 65535)
+
+                numpy.multiply(dn, mult, out=out, dtype=numpy.float32)
+                out += add
+
+                if out is not dn:
+                    out *= self.reflectance_scale
+                    numpy.rint(out, out=out)
+                    numpy.clip(out, 1, 65535, out=out)
+                    numpy.copyto(dn, out, casting='unsafe', where=~keep)
+                else:
+                    out[keep] = 0
+
+        self._map(convert, range(len(bands)))
+
+        return bands
 
     def _unzip(self, src, dst, scene, force_unzip=False):
         """ Unzip tar files """
         self.output("Unzipping %s - It might take some time" % scene, normal=True, arrow=True)
 
         try:
+            if self.selective_unzip:
+                members = self._required_members(scene)
+                if not force_unzip:
+                    members = self._missing_members(dst, members)
+
+                if not members:
+                    self.output('%s is already unzipped.' % scene, normal=True, color='green', indent=1)
+                    return
+
+                self._extract(src, dst, members)
+                return
+
             # check if file is already unzipped, skip
             if isdir(dst) and not force_unzip:
                 self.output('%s is already unzipped.' % scene, normal=True, color='green', indent=1)
                 return
             else:
-                tar = tarfile.open(src, 'r')
-                tar.extractall(path=dst)
-                tar.close()
+                self._extract(src, dst)
         except tarfile.ReadError:
             check_create_folder(dst)
             subprocess.check_call(['tar', '-xf', src, '-C', dst])
 
+    def _required_members(self, scene):
+        """ Names (without extension) of the files needed to process the bands """
+        members = ['%s_B%s' % (scene, band) for band in self.bands]
+
+        for name in ['%s_BQA' % scene, '%s_MTL' % scene]:
+            if name not in members:
+                members.append(name)
+
+        return members
+
+    def _missing_members(self, dst, members):
+        """ Returns the members that are not extracted in dst yet """
+        if not isdir(dst):
+            return members
+
+        extracted = [get_filename(f) for f in os.listdir(dst)]
+        return [member for member in members if member not in extracted]
+
+    def _extract(self, src, dst, members=None):
+        """ Extracts the tar file, or only the given members of it. bzip2 files are decompressed
+        with a pool of processes if unzip_processes is above one, unless this process is a daemon,
+        which cannot have children.
+        """
+        if (self.unzip_processes > 1 and get_file(src).split('.')[-1] in ['bz', 'bz2'] and
+                not multiprocessing.current_process().daemon):
+            try:
+                reader = ParallelBZ2File(src, self.unzip_processes)
+                try:
+                    return self._extract_tar(tarfile.open(fileobj=io.BufferedReader(reader), mode='r|'),
+                                             dst, members)
+                finally:
+                    reader.close()
+            except (IOError, OSError, EOFError) as e:
+                self.output('Parallel decompression failed (%s), falling back to tarfile' % e,
+                            normal=True, color='red', indent=1)
+
+        return self._extract_tar(tarfile.open(src, 'r|*' if members else 'r'), dst, members)
+
+    def _extract_tar(self, tar, dst, members=None):
+        """ Extracts an opened tar file and closes it """
+        try:
+            if members:
+                self._extract_members(tar, dst, members)
+            else:
+                tar.extractall(path=dst)
+        finally:
+            tar.close()
+
+    def _extract_members(self, tar, dst, members):
+        """ Streams through the tar file once and only extracts the given members. Reading stops as soon
+        as all of them are written.
+        """
+        check_create_folder(dst)
+        members = set(members)
+
+        for member in tar:
+            name = get_file(member.name)
+            if not member.isfile() or get_filename(name) not in members:
+                continue
+
+            self.output(name, normal=True, color='green', indent=1)
+
+            # Write to a temporary file first so an interrupted extraction is not mistaken for a complete one
+            with open(join(dst, name + '.part'), 'wb') as f:
+                copyfileobj(tar.extractfile(member), f)
+            os.rename(join(dst, name + '.part'), join(dst, name))
+
+            members.discard(get_filename(name))
+            if not members:
+                break
+
     def _get_full_filename(self, band):
 
         base_file = '%s_B%s.*' % (self.scene, band)
@@ -195,29 +482,11 @@ class BaseProcess(VerbosityMixin):
         return False
 
     def _read_metadata(self):
-        output = {}
+        """ Returns the metadata of the scene, or empty metadata if the MTL file is missing """
         try:
-            with open(self.scene_path + '/' + self.scene + '_MTL.txt', 'rU') as mtl:
-                lines = mtl.readlines()
-                for line in lines:
-                    if 'REFLECTANCE_ADD_BAND_3' in line:
-                        output['REFLECTANCE_ADD_BAND_3'] = float(line.replace('REFLECTANCE_ADD_BAND_3 = ', ''))
-
-                    if 'REFLECTANCE_MULT_BAND_3' in line:
-                        output['REFLECTANCE_MULT_BAND_3'] = float(line.replace('REFLECTANCE_MULT_BAND_3 = ', ''))
-
-                    if 'REFLECTANCE_ADD_BAND_4' in line:
-                        output['REFLECTANCE_ADD_BAND_4'] = float(line.replace('REFLECTANCE_ADD_BAND_4 = ', ''))
-
-                    if 'REFLECTANCE_MULT_BAND_4' in line:
-                        output['REFLECTANCE_MULT_BAND_4'] = float(line.replace('REFLECTANCE_MULT_BAND_4 = ', ''))
-
-                    if 'CLOUD_COVER' in line:
-                        output['CLOUD_COVER'] = float(line.replace('CLOUD_COVER = ', ''))
-
-                    return output
-        except IOError:
-            return output
+            return read_metadata(join(self.scene_path, self.scene + '_MTL.txt'))
+        except (IOError, OSError):
+            return Metadata({})
 
     def _get_image_data(self):
         src = rasterio.open(self.bands_path[-1])
@@ -234,55 +503,248 @@ class BaseProcess(VerbosityMixin):
             'dst_transform': None
         }
 
-        image_data['dst_transform'] = self._get_boundaries(image_data, image_data['shape'])
+        # With a virtual clip the image is the window of the band
+        window = self.windows.get(self.bands[-1])
+        if window:
+            affine = src.window_transform(window)
+            image_data.update({
+                'transform': affine.to_gdal(),
+                'affine': affine,
+                'shape': (window[0][1] - window[0][0], window[1][1] - window[1][0])
+            })
+
+        image_data['dst_transform'] = self._get_dst_transform(image_data)
 
         return image_data
 
+    def _get_dst_transform(self, image_data):
+        """ Returns the destination transform of the image. Scenes of the same path/row share the same
+        source grid, so with grid_cache the result is stored and reused across runs.
+        """
+        if not self.grid_cache:
+            return self._get_boundaries(image_data, image_data['shape'])
+
+        key = [dict(image_data['crs']), list(image_data['transform']), list(image_data['shape']),
+               self.projection, self.pixel]
+
+        cache = JSONCache(settings.GRID_CACHE)
+        dst_transform = cache.get(key)
+
+        if dst_transform is None:
+            dst_transform = cache.set(key, self._get_boundaries(image_data, image_data['shape']))
+        else:
+            self.output("Using cached boundaries", normal=True, arrow=True)
+
+        return tuple(dst_transform)
+
     def _generate_new_bands(self, shape):
         new_bands = []
         for i in range(0, 3):
-            new_bands.append(numpy.empty(shape, dtype=numpy.uint16))
+            new_bands.append(self._allocate(shape, numpy.uint16))
 
         return new_bands
 
+    def _allocate(self, shape, dtype):
+        """ Returns an empty array for intermediate data. If a scratch folder is set, the array is a
+        numpy.memmap backed by a file in that folder, so the operating system can page it out.
+        """
+        if not self.scratch_dir:
+            return numpy.empty(shape, dtype=dtype)
+
+        if not self.scratch_path:
+            self.scratch_path = tempfile.mkdtemp(prefix='%s_' % self.scene, dir=check_create_folder(self.scratch_dir))
+
+        handle, path = tempfile.mkstemp(suffix='.dat', dir=self.scratch_path)
+        os.close(handle)
+
+        return numpy.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+    def _cleanup_scratch(self):
+        """ Removes the memory mapped files of this run """
+        if self.scratch_path:
+            rmtree(self.scratch_path, ignore_errors=True)
+            self.scratch_path = None
+
     @rasterio_decorator
-    def _write_to_file(self, new_bands, **kwargs):
+    def _write_to_file(self, new_bands, suffix=None, **kwargs):
 
         # Read coverage from QBA
         coverage = self._calculate_cloud_ice_perc()
 
         self.output("Final Steps", normal=True, arrow=True)
 
-        suffix = 'bands_%s' % "".join(map(str, self.bands))
+        suffix = suffix or 'bands_%s' % "".join(map(str, self.bands))
 
         output_file = join(self.dst_path, self._filename(suffix=suffix))
 
-        output = rasterio.open(output_file, 'w', **kwargs)
+        output = self._create_output(output_file, **kwargs)
+
+        cuts = self._color_cuts(new_bands, 0, coverage)
 
         for i, band in enumerate(new_bands):
             # Color Correction
-            band = self._color_correction(band, self.bands[i], 0, coverage)
-
-            output.write_band(i + 1, img_as_ubyte(band))
+            output.write_band(i + 1, self._correct_band(band, self.bands[i], 0, coverage, cuts[i]))
 
             new_bands[i] = None
         self.output("Writing to file", normal=True, color='green', indent=1)
+        output.close()
+
+        return self._finish_output(output_file)
+
+    @rasterio_decorator
+    def _write_blocks(self, image_data, suffix, **kwargs):
+        """ Writes the image block by block. The blocks are generated twice: the first pass collects
+        the histograms used for color correction and the second one corrects and writes them.
+        """
+
+        # Read coverage from QBA
+        coverage = self._calculate_cloud_ice_perc()
+
+        srcs = self._open_bands()
+
+        # With a scratch folder the blocks of the first pass are kept on disk instead of being reprojected again
+        store = None
+        if self.scratch_dir:
+            store = self._allocate((kwargs['count'],) + tuple(image_data['shape']), numpy.uint16)
+
+        self.output("Collecting band statistics", normal=True, arrow=True)
+        histograms = [Histogram() for i in range(kwargs['count'])]
+        for window in self._block_windows(image_data['shape']):
+            for i, band in enumerate(self._prepare_block(self._warp_block(image_data, srcs, window))):
+                histograms[i].update(band)
+                if store is not None:
+                    store[i, window[0][0]:window[0][1], window[1][0]:window[1][1]] = band
+
+        luts = [self._color_lut(histogram.cuts(0, 100 - (coverage * 3 / 4)), coverage) for histogram in histograms]
+
+        self.output("Final Steps", normal=True, arrow=True)
+
+        output_file = join(self.dst_path, self._filename(suffix=suffix))
+
+        with self._create_output(output_file, **kwargs) as output:
+            for window in self._block_windows(image_data['shape']):
+                if store is not None:
+                    bands = store[:, window[0][0]:window[0][1], window[1][0]:window[1][1]]
+                else:
+                    bands = self._prepare_block(self._warp_block(image_data, srcs, window))
+
+                for i, band in enumerate(bands):
+                    # Color Correction
+                    output.write_band(i + 1, numpy.take(luts[i], band), window=window)
+
+        for src in srcs:
+            src.close()
+
+        self.output("Writing to file", normal=True, color='green', indent=1)
+
+        return self._finish_output(output_file)
+
+    def _prepare_block(self, blocks):
+        """ Returns the bands of a reprojected block that have to be color corrected and written """
+        return blocks
+
+    def _creation_options(self):
+        """ Returns the GeoTIFF creation options of the output profile """
+        return dict((key, value) for key, value in self.output_profile.items() if key != 'overviews')
+
+    def _create_output(self, output_file, **kwargs):
+        """ Opens the output file for writing with the creation options of the output profile.
+        Images with overviews are written to a temporary file first, see _finish_output.
+        """
+        kwargs.update(self._creation_options())
+
+        if self.output_profile.get('overviews'):
+            output_file += '.tmp'
+
+        return rasterio.open(output_file, 'w', **kwargs)
+
+    def _finish_output(self, output_file):
+        """ Adds the overviews of the output profile to a closed output file.
+
+        GDAL appends overviews built in place after the image data, so the image is copied once more
+        to store the overviews first and the tiles in order (cloud optimized GeoTIFF layout).
+
+        :param output_file:
+            Path to the output file
+        :type output_file:
+            String
+
+        :returns:
+            (String) path to the output file
+        """
+        overviews = self.output_profile.get('overviews')
+        if not overviews:
+            return output_file
+
+        self.output("Building overviews", normal=True, color='green', indent=1)
+
+        temp = output_file + '.tmp'
+        with rasterio.open(temp, 'r+') as output:
+            # Overviews smaller than a tile are of no use
+            factors = [factor for factor in overviews if max(output.shape) // factor >= 256]
+            if factors:
+                output.build_overviews(factors, RESAMPLING.average)
+
+        rasterio.copy(temp, output_file, driver='GTiff', COPY_SRC_OVERVIEWS=True, **self._creation_options())
+        os.remove(temp)
 
         return output_file
 
-    def _color_correction(self, band, band_id, low, coverage):
+    def _color_cuts(self, bands, low, coverage):
+        """ Calculates the color correction cuts of all bands. uint16 bands are read once to build
+        their histogram, other bands fall back to numpy.percentile.
+        """
+        if self.bands == [4, 5]:
+            return [None for band in bands]
+
+        cuts = []
+        for band in bands:
+            if band.dtype == numpy.uint16:
+                cuts.append(Histogram().update(band).cuts(low, 100 - (coverage * 3 / 4)))
+            else:
+                p_low, cloud_cut_low = self._percent_cut(band, low, 100 - (coverage * 3 / 4))
+                cuts.append((p_low, cloud_cut_low, 'image'))
+
+        return cuts
+
+    def _correct_band(self, band, band_id, low, coverage, cuts=None):
+        """ Color corrects a band and converts it to uint8. uint16 bands are corrected with a lookup table,
+        which gives the same output as _color_correction followed by img_as_ubyte.
+        """
+        if band.dtype == numpy.uint16 and cuts:
+            self.output("Color correcting band %s" % band_id, normal=True, color='green', indent=1)
+            return numpy.take(self._color_lut(cuts, coverage), band)
+
+        return img_as_ubyte(self._color_correction(band, band_id, low, coverage, cuts))
+
+    def _color_lut(self, cuts, coverage):
+        """ Returns a lookup table with the color corrected uint8 value of every uint16 value.
+        The table is built by running the regular color correction on all 65536 values.
+        """
+        p_low, cloud_cut_low, high_range = cuts
+        values = numpy.arange(65536, dtype=numpy.uint16)
+
+        return img_as_ubyte(self._stretch(values, p_low, cloud_cut_low, coverage, high_range))
+
+    def _color_correction(self, band, band_id, low, coverage, cuts=None):
         if self.bands == [4, 5]:
             return band
         else:
             self.output("Color correcting band %s" % band_id, normal=True, color='green', indent=1)
-            p_low, cloud_cut_low = self._percent_cut(band, low, 100 - (coverage * 3 / 4))
-            temp = numpy.zeros(numpy.shape(band), dtype=numpy.uint16)
-            cloud_divide = 65000 - coverage * 100
-            mask = numpy.logical_and(band < cloud_cut_low, band > 0)
-            temp[mask] = rescale_intensity(band[mask], in_range=(p_low, cloud_cut_low), out_range=(256, cloud_divide))
-            temp[band >= cloud_cut_low] = rescale_intensity(band[band >= cloud_cut_low],
-                                                            out_range=(cloud_divide, 65535))
-            return temp
+            p_low, cloud_cut_low, high_range = cuts if cuts else self._color_cuts([band], low, coverage)[0]
+            return self._stretch(band, p_low, cloud_cut_low, coverage, high_range)
+
+    def _stretch(self, band, p_low, cloud_cut_low, coverage, high_range='image'):
+        """ Stretches the pixels below cloud_cut_low between 256 and cloud_divide and the pixels
+        above it (the clouds) between cloud_divide and 65535.
+        """
+        temp = numpy.zeros(numpy.shape(band), dtype=numpy.uint16)
+        cloud_divide = 65000 - coverage * 100
+        high = band >= cloud_cut_low
+        mask = numpy.logical_and(~high, band > 0)
+        temp[mask] = rescale_intensity(band[mask], in_range=(p_low, cloud_cut_low), out_range=(256, cloud_divide))
+        temp[high] = rescale_intensity(band[high], in_range=high_range, out_range=(cloud_divide, 65535))
+        return temp
 
     def _percent_cut(self, color, low, high):
         return numpy.percentile(color[numpy.logical_and(color > 0, color < 65535)], (low, high))
@@ -290,21 +752,64 @@ class BaseProcess(VerbosityMixin):
     def _calculate_cloud_ice_perc(self):
         """ Return the percentage of pixels that are either cloud or snow with
         high confidence (> 67%).
+
+        The result is stored in a sidecar file next to the QA band, so the QA band is only read
+        once per scene, decimation and virtual clip.
         """
         self.output('Calculating cloud and snow coverage from QA band', normal=True, arrow=True)
-        a = rasterio.open(join(self.scene_path, self._get_full_filename('QA'))).read_band(1)
 
+        qa_path = join(self.scene_path, self._get_full_filename('QA'))
+        sidecar = join(self.scene_path, self.scene + '_coverage.json')
+        stat = os.stat(qa_path)
+        window = self.windows.get('QA')
+        key = fingerprint(get_file(qa_path), stat.st_size, int(stat.st_mtime), self.qa_decimation, window)
+
+        coverage = read_json(sidecar, {})
+        if key not in coverage:
+            coverage[key] = self._qa_coverage(qa_path, window)
+            try:
+                write_json(sidecar, coverage)
+            except (IOError, OSError):
+                # The folder may be read only
+                pass
+
+        perc = coverage[key]
+        self.output('cloud/snow coverage: %s' % round(perc, 2), indent=1, normal=True, color='green')
+        return perc
+
+    def _qa_coverage(self, qa_path, window=None):
+        """ Calculates the cloud and snow coverage of a QA band, or of a window of it.
+
+        The band is read in blocks of rows and only the histogram of the QA values is kept. The
+        flags are then tested once per distinct value instead of once per pixel.
+        """
         cloud_high_conf = int('1100000000000000', 2)
         snow_high_conf = int('0000110000000000', 2)
         fill_pixels = int('0000000000000001', 2)
-        cloud_mask = numpy.bitwise_and(a, cloud_high_conf) == cloud_high_conf
-        snow_mask = numpy.bitwise_and(a, snow_high_conf) == snow_high_conf
-        fill_mask = numpy.bitwise_and(a, fill_pixels) == fill_pixels
 
-        perc = numpy.true_divide(numpy.sum(cloud_mask | snow_mask),
-                                 a.size - numpy.sum(fill_mask)) * 100.0
-        self.output('cloud/snow coverage: %s' % round(perc, 2), indent=1, normal=True, color='green')
-        return perc
+        histogram = Histogram()
+        decimation = self.qa_decimation
+
+        with rasterio.open(qa_path) as src:
+            (row_start, row_stop), (col_start, col_stop) = window or ((0, src.height), (0, src.width))
+            width = col_stop - col_start
+            rows = (self.block_size or 512) * decimation
+
+            for top in range(row_start, row_stop, rows):
+                bottom = min(top + rows, row_stop)
+                # A smaller out array makes GDAL read every decimation-th pixel
+                shape = ((bottom - top + decimation - 1) // decimation, (width + decimation - 1) // decimation)
+                out = numpy.empty(shape, dtype=numpy.uint16)
+                histogram.update(src.read(1, window=((top, bottom), (col_start, col_stop)), out=out))
+
+        values = numpy.arange(65536)
+        cloud_mask = numpy.bitwise_and(values, cloud_high_conf) == cloud_high_conf
+        snow_mask = numpy.bitwise_and(values, snow_high_conf) == snow_high_conf
+        fill_mask = numpy.bitwise_and(values, fill_pixels) == fill_pixels
+
+        counts = histogram.counts
+        return float(numpy.true_divide(counts[cloud_mask | snow_mask].sum(),
+                                       counts.sum() - counts[fill_mask].sum()) * 100.0)
 
     def _filename(self, name=None, suffix=None, prefix=None):
         """ File name generator for processed images """
@@ -343,41 +848,36 @@ class BaseProcess(VerbosityMixin):
         # create new folder for clipped images
         path = check_create_folder(join(self.scene_path, 'clipped'))
 
+        cache = FileCache(settings.CLIP_CACHE, settings.CLIP_CACHE_SIZE, '.TIF') if self.clip_cache else None
+
         try:
             temp_bands = copy(self.bands)
             temp_bands.append('QA')
             for i, band in enumerate(temp_bands):
                 band_name = self._get_full_filename(band)
                 band_path = join(self.scene_path, band_name)
+                clipped_path = join(path, band_name)
+
+                # The clipped band may be a link to a cache entry, which must not be overwritten
+                if os.path.exists(clipped_path):
+                    os.remove(clipped_path)
 
                 self.output("Band %s" % band, normal=True, color='green', indent=1)
-                with rasterio.open(band_path) as src:
-                    bounds = transform_bounds(
-                        {
-                            'proj': 'longlat',
-                            'ellps': 'WGS84',
-                            'datum': 'WGS84',
-                            'no_defs': True
-                        },
-                        src.crs,
-                        *self.bounds
-                    )
-
-                    if disjoint_bounds(bounds, src.bounds):
-                        bounds = adjust_bounding_box(src.bounds, bounds)
-
-                    window = src.window(*bounds)
-
-                    out_kwargs = src.meta.copy()
-                    out_kwargs.update({
-                        'driver': 'GTiff',
-                        'height': window[0][1] - window[0][0],
-                        'width': window[1][1] - window[1][0],
-                        'transform': src.window_transform(window)
-                    })
-
-                    with rasterio.open(join(path, band_name), 'w', **out_kwargs) as out:
-                        out.write(src.read(window=window))
+
+                if cache is None:
+                    self._clip_band(band_path, clipped_path)
+                    continue
+
+                stat = os.stat(band_path)
+                key = [self.scene, self.bounds, band_name, stat.st_size, int(stat.st_mtime)]
+
+                cached = cache.get(key)
+                if cached is None:
+                    cached = cache.add(key, lambda temp: self._clip_band(band_path, temp))
+                else:
+                    self.output("Using cached clip", normal=True, color='green', indent=2)
+
+                link(cached, clipped_path)
 
             # Copy MTL to the clipped folder
             copyfile(join(self.scene_path, self.scene + '_MTL.txt'), join(path, self.scene + '_MTL.txt'))
@@ -387,9 +887,61 @@ class BaseProcess(VerbosityMixin):
         except IOError as e:
             exit(e.message, 1)
 
+    def _clip_band(self, band_path, clipped_path):
+        """ Writes the window of a band that covers the bounds to clipped_path """
+        with rasterio.open(band_path) as src:
+            window = self._clip_window(src)
+
+            out_kwargs = src.meta.copy()
+            out_kwargs.update({
+                'driver': 'GTiff',
+                'height': window[0][1] - window[0][0],
+                'width': window[1][1] - window[1][0],
+                'transform': src.window_transform(window)
+            })
+
+            with rasterio.open(clipped_path, 'w', **out_kwargs) as out:
+                out.write(src.read(window=window))
+
+    @rasterio_decorator
+    def _clip_windows(self):
+        """ Returns the window of each band, including the QA band, that covers the bounds. The bands
+        are then only read in these windows instead of being clipped to new files.
+        """
+        self.output("Clipping", normal=True)
+
+        windows = {}
+        try:
+            for band in self.bands + ['QA']:
+                with rasterio.open(join(self.scene_path, self._get_full_filename(band))) as src:
+                    windows[band] = self._clip_window(src)
+        except IOError as e:
+            exit(e.message, 1)
+
+        return windows
+
+    def _clip_window(self, src):
+        """ Returns the window of an opened band that covers the bounds """
+        bounds = transform_bounds(
+            {
+                'proj': 'longlat',
+                'ellps': 'WGS84',
+                'datum': 'WGS84',
+                'no_defs': True
+            },
+            src.crs,
+            *self.bounds
+        )
+
+        if disjoint_bounds(bounds, src.bounds):
+            bounds = adjust_bounding_box(src.bounds, bounds)
+
+        return src.window(*bounds)
+
 
 class Simple(BaseProcess):
 
+    @scratch_decorator
     @rasterio_decorator
     def run(self):
         """ Executes the image processing.
@@ -400,16 +952,8 @@ class Simple(BaseProcess):
 
         self.output('Image processing started for bands %s' % '-'.join(map(str, self.bands)), normal=True, arrow=True)
 
-        bands = self._read_bands()
         image_data = self._get_image_data()
 
-        new_bands = self._generate_new_bands(image_data['shape'])
-
-        self._warp(image_data, bands, new_bands)
-
-        # Bands are no longer needed
-        del bands
-
         rasterio_options = {
             'driver': 'GTiff',
             'width': image_data['shape'][1],
@@ -422,6 +966,18 @@ class Simple(BaseProcess):
             'crs': self.dst_crs
         }
 
+        if self.block_size:
+            return self._write_blocks(image_data, 'bands_%s' % "".join(map(str, self.bands)), **rasterio_options)
+
+        bands = self._read_bands()
+
+        new_bands = self._generate_new_bands(image_data['shape'])
+
+        self._warp(image_data, bands, new_bands)
+
+        # Bands are no longer needed
+        del bands
+
         return self._write_to_file(new_bands, **rasterio_options)
 
 
@@ -436,6 +992,7 @@ class PanSharpen(BaseProcess):
         self.band8 = bands.index(8)
         super(PanSharpen, self).__init__(path, bands, **kwargs)
 
+    @scratch_decorator
     @rasterio_decorator
     def run(self):
         """ Executes the pansharpen image processing.
@@ -446,24 +1003,8 @@ class PanSharpen(BaseProcess):
         self.output('PanSharpened Image processing started for bands %s' % '-'.join(map(str, self.bands)),
                     normal=True, arrow=True)
 
-        bands = self._read_bands()
         image_data = self._get_image_data()
 
-        new_bands = self._generate_new_bands(image_data['shape'])
-
-        bands[:3] = self._rescale(bands[:3])
-        new_bands.append(numpy.empty(image_data['shape'], dtype=numpy.uint16))
-
-        self._warp(image_data, bands, new_bands)
-
-        # Bands are no longer needed
-        del bands
-
-        # Calculate pan band
-        pan = self._pansize(new_bands)
-        del self.bands[self.band8]
-        del new_bands[self.band8]
-
         rasterio_options = {
             'driver': 'GTiff',
             'width': image_data['shape'][1],
@@ -476,44 +1017,93 @@ class PanSharpen(BaseProcess):
             'crs': self.dst_crs
         }
 
-        return self._write_to_file(new_bands, pan, **rasterio_options)
+        if self.block_size:
+            # The pan ratio is applied to each block as it is written
+            self.output('Calculating Pan Ratio', normal=True, arrow=True)
+            rgb_bands = [band for i, band in enumerate(self.bands) if i != self.band8]
+            return self._write_blocks(image_data, 'bands_%s_pan' % "".join(map(str, rgb_bands)), **rasterio_options)
 
-    @rasterio_decorator
-    def _write_to_file(self, new_bands, pan, **kwargs):
+        bands = self._read_bands()
 
-        # Read coverage from QBA
-        coverage = self._calculate_cloud_ice_perc()
+        new_bands = self._generate_new_bands(image_data['shape'])
 
-        self.output("Final Steps", normal=True, arrow=True)
+        bands[:3] = self._rescale(bands[:3])
+        new_bands.append(self._allocate(image_data['shape'], numpy.uint16))
 
-        suffix = 'bands_%s_pan' % "".join(map(str, self.bands))
+        self._warp(image_data, bands, new_bands)
 
-        output_file = join(self.dst_path, self._filename(suffix=suffix))
+        # Bands are no longer needed
+        del bands
 
-        output = rasterio.open(output_file, 'w', **kwargs)
+        # Calculate pan band
+        self.output('Calculating Pan Ratio', normal=True, arrow=True)
+        self._brovey(new_bands)
+        del self.bands[self.band8]
+        del new_bands[self.band8]
 
-        for i, band in enumerate(new_bands):
-            # Color Correction
-            band = numpy.multiply(band, pan)
-            band = self._color_correction(band, self.bands[i], 0, coverage)
+        return self._write_to_file(new_bands, 'bands_%s_pan' % "".join(map(str, self.bands)), **rasterio_options)
 
-            output.write_band(i + 1, img_as_ubyte(band))
+    def _resampling(self, index):
+        """ The 30m bands are upsampled to the 15m grid of the pan band with bilinear resampling """
+        if index == self.band8:
+            return RESAMPLING.nearest
+        return RESAMPLING.bilinear
 
-            new_bands[i] = None
+    def _prepare_block(self, blocks):
+        """ Applies the pan ratio to the rgb bands of a block """
+        self._brovey(blocks)
+        del blocks[self.band8]
 
-        self.output("Writing to file", normal=True, color='green', indent=1)
+        return blocks
 
-        return output_file
+    def _brovey(self, bands, rows=256):
+        """ Multiplies the rgb bands in place by the ratio of the pan band to their sum (Brovey transform).
 
-    def _pansize(self, bands):
+        The bands are processed rows at a time in float32 buffers that are allocated once, and the result
+        is truncated to uint16. The sum of the rgb bands is exact in float32, so each product is at most
+        the pan value and fits in uint16.
 
-        self.output('Calculating Pan Ratio', normal=True, arrow=True)
+        :param bands:
+            The uint16 rgb and pan bands, or blocks of them
+        :type bands:
+            List
+        :param rows:
+            Number of rows processed at a time
+        :type rows:
+            int
 
-        m = numpy.add(bands[0], bands[1])
-        m = numpy.add(m, bands[2])
-        pan = numpy.multiply(numpy.nan_to_num(numpy.true_divide(1, m)), bands[self.band8])
+        :returns:
+            The bands
+        """
+        pan = bands[self.band8]
+        rgb = [band for i, band in enumerate(bands) if i != self.band8]
+        height, width = pan.shape
+
+        total = numpy.empty((min(rows, height), width), dtype=numpy.float32)
+        ratio = numpy.empty(total.shape, dtype=numpy.float32)
+        product = numpy.empty(total.shape, dtype=numpy.float32)
+
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            m = total[:bottom - top]
+            r = ratio[:bottom - top]
+            p = product[:bottom - top]
 
-        return pan
+            numpy.add(rgb[0][top:bottom], rgb[1][top:bottom], out=m, dtype=numpy.float32)
+            numpy.add(m, rgb[2][top:bottom], out=m)
+
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                numpy.true_divide(pan[top:bottom], m, out=r)
+
+                for band in rgb:
+                    numpy.multiply(band[top:bottom], r, out=p, dtype=numpy.float32)
+
+                    # Same as numpy.nan_to_num followed by numpy.clip, without the copies
+                    numpy.copyto(p, 0, where=numpy.isnan(p))
+                    numpy.clip(p, 0, 65535, out=p)
+                    numpy.copyto(band[top:bottom], p, casting='unsafe')
+
+        return bands
 
     def _rescale(self, bands):
         """ Rescale bands """
@@ -521,11 +1111,71 @@ class PanSharpen(BaseProcess):
 
         for key, band in enumerate(bands):
             self.output("band %s" % self.bands[key], normal=True, color='green', indent=1)
-            bands[key] = sktransform.rescale(band, 2)
-            bands[key] = (bands[key] * 65535).astype('uint16')
+            rescaled = self._allocate((band.shape[0] * 2, band.shape[1] * 2), numpy.uint16)
+            bands[key] = self._upsample(band, rescaled)
 
         return bands
 
+    def _upsample(self, band, output, rows=128):
+        """ Upsamples a band by 2 with bilinear interpolation, like skimage.transform.rescale(band, 2)
+        with pixels beyond the edges being 0.
+
+        The band is processed rows at a time in float32. The result of each pixel is exact in float32,
+        so the only difference with the float64 rescale is that values are not off by one when the
+        float64 result of an integer value is rounded down.
+
+        :param band:
+            The band
+        :type band:
+            numpy.ndarray
+        :param output:
+            uint16 array twice the height and width of the band
+        :type output:
+            numpy.ndarray
+        :param rows:
+            Number of band rows processed at a time
+        :type rows:
+            int
+
+        :returns:
+            The output array
+        """
+        height, width = band.shape
+
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+
+            # The rows around the chunk are needed to interpolate its first and last rows
+            first = max(top - 1, 0)
+            last = min(bottom + 1, height)
+
+            horizontal = numpy.empty((last - first, width * 2), dtype=numpy.float32)
+            self._interpolate(band[first:last].astype(numpy.float32), horizontal)
+
+            vertical = numpy.empty(((last - first) * 2, width * 2), dtype=numpy.float32)
+            self._interpolate(horizontal.T, vertical.T)
+
+            offset = (top - first) * 2
+            output[top * 2:bottom * 2] = vertical[offset:offset + (bottom - top) * 2]
+
+        return output
+
+    def _interpolate(self, chunk, out):
+        """ Interpolates the columns of chunk at half pixel steps into the twice as wide out """
+        # Output pixel j lies at (j + 0.5) / 2 - 0.5 in the input, a quarter pixel from the nearest input pixel
+        even = out[:, 2::2]
+        numpy.multiply(chunk[:, 1:], 0.75, out=even)
+        even += chunk[:, :-1] * 0.25
+
+        odd = out[:, 1:-1:2]
+        numpy.multiply(chunk[:, :-1], 0.75, out=odd)
+        odd += chunk[:, 1:] * 0.25
+
+        numpy.multiply(chunk[:, 0], 0.75, out=out[:, 0])
+        numpy.multiply(chunk[:, -1], 0.75, out=out[:, -1])
+
+        return out
+
 if __name__ == '__main__':
 
     p = PanSharpen('/Users/ajdevseed/Desktop/LC81950282014159LGN00')
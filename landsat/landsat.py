@@ -7,14 +7,23 @@ from __future__ import print_function, division, absolute_import
 
 import argparse
 import textwrap
+import os
 import json
-from os.path import join
+import time
+import multiprocessing
+from os.path import join, isdir
 
 try:
     from urllib.request import URLError
 except ImportError:
     from urllib2 import URLError
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where --memory-limit is not supported
+    resource = None
+
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse
@@ -23,6 +32,7 @@ from boto.exception import NoAuthHandlerFound
 from .downloader import Downloader, IncorrectSceneId, RemoteFileDoesntExist, USGSInventoryAccessMissing
 from .search import Search
 from .uploader import Uploader
+from .cache import JSONCache
 from .utils import reformat_date, convert_to_integer_list, timer, exit, get_file, convert_to_float_list
 from .mixins import VerbosityMixin
 from .image import Simple, PanSharpen, FileDoesNotExist
@@ -114,6 +124,21 @@ search, download, and process Landsat imagery.
 
                 --force-unzip       Force unzip tar file
 
+                --threads           Number of threads used to reproject the bands concurrently. Default: 1
+
+                --selective-unzip   Only extract the processed bands, the QA band and the MTL file from the tar file
+
+                --output-profile    Compression and layout of the processed image: default, deflate, lzw, zstd
+                                    or cog (tiled, compressed and with overviews). Default: default
+
+                --workers           Number of scenes processed at the same time. Default: 1
+
+                --memory-limit      Maximum memory in MB of each process that processes a scene
+
+                --download-threads  Number of files downloaded at the same time. Default: 1
+
+                --download-cache    Keep the downloaded files in a cache shared by all downloads of this computer
+
                 --username          USGS Eros account Username (only works if the account has special
                                     inventory access). Username and password as a fallback if the image
                                     is not found on AWS S3 or Google Storage
@@ -160,6 +185,13 @@ search, download, and process Landsat imagery.
                 --region            URL to S3 region e.g. s3-us-west-2.amazonaws.com
 
                 --force-unzip       Force unzip tar file
+
+                --threads           Number of threads used to reproject the bands concurrently. Default: 1
+
+                --selective-unzip   Only extract the processed bands, the QA band and the MTL file from the tar file
+
+                --output-profile    Compression and layout of the processed image: default, deflate, lzw, zstd
+                                    or cog (tiled, compressed and with overviews). Default: default
 """
 
 
@@ -242,6 +274,21 @@ def args_options():
     parser_download.add_argument('--bucket', help='Bucket name (required if uploading to s3)')
     parser_download.add_argument('--region', help='URL to S3 region e.g. s3-us-west-2.amazonaws.com')
     parser_download.add_argument('--force-unzip', help='Force unzip tar file', action='store_true')
+    parser_download.add_argument('--threads', type=int, default=1,
+                                 help='Number of threads used to reproject the bands concurrently. Default is 1')
+    parser_download.add_argument('--selective-unzip', action='store_true',
+                                 help='Only extract the processed bands, the QA band and the MTL file from the '
+                                 'tar file')
+    parser_download.add_argument('--output-profile', default='default', choices=sorted(settings.OUTPUT_PROFILES),
+                                 help='Compression and layout of the processed image. Default is default')
+    parser_download.add_argument('--workers', type=int, default=1,
+                                 help='Number of scenes processed at the same time. Default is 1')
+    parser_download.add_argument('--memory-limit', type=int,
+                                 help='Maximum memory in MB of each process that processes a scene')
+    parser_download.add_argument('--download-threads', type=int, default=1,
+                                 help='Number of files downloaded at the same time. Default is 1')
+    parser_download.add_argument('--download-cache', action='store_true',
+                                 help='Keep the downloaded files in a cache shared by all downloads of this computer')
 
     parser_process = subparsers.add_parser('process', help='Process Landsat imagery')
     parser_process.add_argument('path',
@@ -269,6 +316,12 @@ def args_options():
     parser_process.add_argument('--bucket', help='Bucket name (required if uploading to s3)')
     parser_process.add_argument('--region', help='URL to S3 region e.g. s3-us-west-2.amazonaws.com')
     parser_process.add_argument('--force-unzip', help='Force unzip tar file', action='store_true')
+    parser_process.add_argument('--threads', type=int, default=1,
+                                help='Number of threads used to reproject the bands concurrently. Default is 1')
+    parser_process.add_argument('--selective-unzip', action='store_true',
+                                help='Only extract the processed bands, the QA band and the MTL file from the tar file')
+    parser_process.add_argument('--output-profile', default='default', choices=sorted(settings.OUTPUT_PROFILES),
+                                help='Compression and layout of the processed image. Default is default')
 
     return parser
 
@@ -302,7 +355,8 @@ def main(args):
             verbose = True if args.verbose else False
             force_unzip = True if args.force_unzip else False
             stored = process_image(args.path, args.bands, verbose, args.pansharpen, args.ndvi, force_unzip,
-                                   args.ndvigrey, bounds)
+                                   args.ndvigrey, bounds, threads=args.threads,
+                                   selective_unzip=args.selective_unzip, output_profile=args.output_profile)
 
             if args.upload:
                 u = Uploader(args.key, args.secret, args.region)
@@ -390,7 +444,11 @@ def main(args):
                 return json.dumps(result)
 
         elif args.subs == 'download':
-            d = Downloader(download_dir=args.dest, usgs_user=args.username, usgs_pass=args.password)
+            if args.memory_limit and resource is None:
+                return ['--memory-limit is not supported on this platform', 1]
+
+            d = Downloader(download_dir=args.dest, usgs_user=args.username, usgs_pass=args.password,
+                           threads=args.download_threads, cache=args.download_cache)
             try:
                 bands = convert_to_integer_list(args.bands)
 
@@ -410,9 +468,18 @@ def main(args):
                     if not args.bands:
                         args.bands = '432'
                     force_unzip = True if args.force_unzip else False
-                    for f in files:
-                        stored = process_image(f, args.bands, False, args.pansharpen, args.ndvi, force_unzip,
-                                               args.ndvigrey, bounds=bounds)
+                    results = process_images(files, (args.bands, False, args.pansharpen, args.ndvi, force_unzip,
+                                                     args.ndvigrey),
+                                             {'bounds': bounds, 'threads': args.threads,
+                                              'selective_unzip': args.selective_unzip,
+                                              'output_profile': args.output_profile},
+                                             workers=args.workers, memory_limit=args.memory_limit)
+
+                    failed = []
+                    for f, stored, error in results:
+                        if error:
+                            failed.append('%s (%s)' % (get_file(f), error))
+                            continue
 
                         if args.upload:
                             try:
@@ -423,6 +490,9 @@ def main(args):
                                 return ["Connection timeout. Probably the region parameter is incorrect", 1]
                             u.run(args.bucket, get_file(stored), stored)
 
+                    if failed:
+                        return ['Processing failed for %s' % ', '.join(failed), 1]
+
                     return ['The output is stored at %s' % stored, 0]
                 else:
                     return ['Download Completed', 0]
@@ -433,7 +503,9 @@ def main(args):
 
 
 def process_image(path, bands=None, verbose=False, pansharpen=False, ndvi=False, force_unzip=None,
-                  ndvigrey=False, bounds=None):
+                  ndvigrey=False, bounds=None, block_size=None, threads=1, selective_unzip=False,
+                  unzip_processes=1, scratch_dir=None, grid_cache=False, output_profile='default',
+                  qa_decimation=1, toa=False, virtual_clip=False, clip_cache=False, result_cache=False):
     """ Handles constructing and image process.
 
     :param path:
@@ -452,30 +524,248 @@ def process_image(path, bands=None, verbose=False, pansharpen=False, ndvi=False,
         Whether to pansharpen the image. Default is False.
     :type pansharpen:
         boolean
+    :param block_size:
+        If provided, the image is processed in blocks of block_size x block_size pixels to limit
+        memory usage. Default is None.
+    :type block_size:
+        int
+    :param threads:
+        Number of threads used to reproject the bands concurrently. Default is 1.
+    :type threads:
+        int
+    :param selective_unzip:
+        Whether to only extract the needed files from the tar file. Default is False.
+    :type selective_unzip:
+        boolean
+    :param unzip_processes:
+        Number of processes used to decompress bzip2 tar files. Default is 1.
+    :type unzip_processes:
+        int
+    :param scratch_dir:
+        Folder where intermediate bands are stored as memory mapped files. (optional)
+    :type scratch_dir:
+        String
+    :param grid_cache:
+        Whether to reuse the destination grid cached for the same path/row. Default is False.
+    :type grid_cache:
+        boolean
+    :param output_profile:
+        Name of the settings.OUTPUT_PROFILES entry used to write the image. Default is 'default'.
+    :type output_profile:
+        String
+    :param qa_decimation:
+        Decimation of the QA band read to calculate the cloud and snow coverage. Default is 1.
+    :type qa_decimation:
+        int
+    :param toa:
+        Whether to convert the bands to top of atmosphere reflectance before NDVI or color correction.
+        Default is False.
+    :type toa:
+        boolean
+    :param virtual_clip:
+        Whether to clip by reading only the window of the bands that covers the bounds, instead of
+        writing clipped bands to disk. Default is False.
+    :type virtual_clip:
+        boolean
+    :param clip_cache:
+        Whether to reuse the bands clipped to the same bounds in an earlier run. Default is False.
+    :type clip_cache:
+        boolean
+    :param result_cache:
+        Whether to return the image processed earlier from the same input files with the same
+        parameters, if it still exists, instead of processing it again. Default is False.
+    :type result_cache:
+        boolean
 
     :returns:
         (String) path to the processed image
     """
+    options = {
+        'dst_path': settings.PROCESSED_IMAGE,
+        'verbose': verbose,
+        'force_unzip': force_unzip,
+        'bounds': bounds,
+        'block_size': block_size,
+        'threads': threads,
+        'selective_unzip': selective_unzip,
+        'unzip_processes': unzip_processes,
+        'scratch_dir': scratch_dir,
+        'grid_cache': grid_cache,
+        'output_profile': output_profile,
+        'qa_decimation': qa_decimation,
+        'toa': toa,
+        'virtual_clip': virtual_clip,
+        'clip_cache': clip_cache
+    }
+
     try:
         bands = convert_to_integer_list(bands)
+
+        if result_cache:
+            # Parameters that change the output
+            key = [_input_version(path), list(bands), pansharpen, ndvi, ndvigrey, bounds, block_size, output_profile,
+                   qa_decimation, toa, virtual_clip]
+            stored = _cached_result(key)
+            if stored:
+                return stored
+
         if pansharpen:
-            p = PanSharpen(path, bands=bands, dst_path=settings.PROCESSED_IMAGE,
-                           verbose=verbose, force_unzip=force_unzip, bounds=bounds)
+            p = PanSharpen(path, bands=bands, **options)
         elif ndvigrey:
-            p = NDVI(path, verbose=verbose, dst_path=settings.PROCESSED_IMAGE, force_unzip=force_unzip, bounds=bounds)
+            p = NDVI(path, **options)
         elif ndvi:
-            p = NDVIWithManualColorMap(path, dst_path=settings.PROCESSED_IMAGE,
-                                       verbose=verbose, force_unzip=force_unzip, bounds=bounds)
+            p = NDVIWithManualColorMap(path, **options)
         else:
-            p = Simple(path, bands=bands, dst_path=settings.PROCESSED_IMAGE, verbose=verbose, force_unzip=force_unzip,
-                       bounds=bounds)
+            p = Simple(path, bands=bands, **options)
 
     except IOError as err:
         exit(str(err), 1)
     except FileDoesNotExist as err:
         exit(str(err), 1)
 
-    return p.run()
+    stored = p.run()
+
+    if result_cache:
+        JSONCache(settings.RESULT_CACHE).set(key, {'path': stored, 'version': _file_version(stored)})
+
+    return stored
+
+
+def _limit_memory(memory_limit):
+    """ Limits the address space of the current process to memory_limit megabytes """
+    limit = memory_limit * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _process_scene(task):
+    """ Processes one scene of a batch and returns its path, the path of the processed image and the error,
+    if any. Errors, including the SystemExit raised by exit(), only fail this scene.
+    """
+    path, args, kwargs = task
+
+    try:
+        return path, process_image(path, *args, **kwargs), None
+    except SystemExit as e:
+        return path, None, 'exited with code %s' % e.code
+    except Exception as e:
+        return path, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def _run_scene(task, connection, memory_limit=None):
+    """ Processes one scene in a worker process and sends the result to the parent process """
+    if memory_limit:
+        _limit_memory(memory_limit)
+
+    connection.send(_process_scene(task))
+    connection.close()
+
+
+def _scene_result(task, process, connection):
+    """ Returns the result sent by a worker process that ended, or an error if it died before sending it """
+    try:
+        if connection.poll():
+            return connection.recv()
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+
+    return task[0], None, 'worker process died with exit code %s' % process.exitcode
+
+
+def process_images(paths, args=(), kwargs=None, workers=1, memory_limit=None):
+    """ Processes a batch of scenes, concurrently if workers is above one.
+
+    Each scene is processed in a process of its own, so a failed scene does not stop the others,
+    even if its process is killed, e.g. when it runs out of memory, and its memory is released
+    before the next scene starts.
+
+    :param paths:
+        The paths to the images that have to be processed
+    :type paths:
+        List
+    :param args:
+        Positional arguments of process_image that follow the path
+    :type args:
+        Tuple
+    :param kwargs:
+        Keyword arguments of process_image
+    :type kwargs:
+        Dictionary
+    :param workers:
+        Number of scenes processed at the same time. Default is 1.
+    :type workers:
+        int
+    :param memory_limit:
+        Maximum memory of each worker process in megabytes. A scene that needs more fails with a
+        MemoryError. Not supported on Windows. (optional)
+    :type memory_limit:
+        int
+
+    :returns:
+        (List) for each path, in order, the path, the path to the processed image and the error, which is
+        None if the scene was processed
+    """
+    if memory_limit and resource is None:
+        raise ValueError('memory_limit is not supported on this platform')
+
+    tasks = [(path, args, kwargs or {}) for path in paths]
+
+    if workers <= 1 and not memory_limit:
+        return [_process_scene(task) for task in tasks]
+
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < max(workers, 1):
+            i = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_scene, args=(tasks[i], sender, memory_limit))
+            process.start()
+            sender.close()
+            running[i] = (process, receiver)
+
+        ended = [i for i, (process, receiver) in running.items() if receiver.poll() or not process.is_alive()]
+        for i in ended:
+            process, receiver = running.pop(i)
+            results[i] = _scene_result(tasks[i], process, receiver)
+            process.join()
+
+        if not ended:
+            time.sleep(0.1)
+
+    return results
+
+
+def _file_version(path):
+    """ Returns the size and modification time of a file """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _input_version(path):
+    """ Returns the absolute path and version of an input file, or of the files of an input folder """
+    if isdir(path):
+        # Only the bands and the MTL file, processing adds other files to the folder
+        names = [name for name in os.listdir(path) if os.path.splitext(name)[1].lower() in ['.tif', '.txt']]
+        return [os.path.abspath(path), sorted([name] + _file_version(join(path, name)) for name in names)]
+
+    return [os.path.abspath(path)] + _file_version(path)
+
+
+def _cached_result(key):
+    """ Returns the path of the image processed earlier for the key, if it was not changed since """
+    result = JSONCache(settings.RESULT_CACHE).get(key)
+
+    try:
+        if result and _file_version(result['path']) == result['version']:
+            return result['path']
+    except OSError:
+        pass
+
+    return None
 
 
 def __main__():
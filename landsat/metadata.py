@@ -0,0 +1,223 @@
+# Landsat Metadata
+# Landsat Util
+# License: CC0 1.0 Universal
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os.path import abspath, dirname, join
+
+from .cache import read_json, write_json
+from .utils import get_file
+
+
+# Parsed metadata of the MTL files read by this process, keyed by path
+_memo = {}
+
+
+def parse_value(value):
+    """ Converts an MTL value to int, float or string.
+
+    :param value:
+        The value as written in the MTL file
+    :type value:
+        String
+
+    :returns:
+        int, float or String
+
+    :example:
+        >>> parse_value('1.2000E-02')
+        0.012
+    """
+    if value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def parse_mtl(lines):
+    """ Parses the lines of an MTL file, which are made of nested ODL groups of fields.
+
+    :param lines:
+        The lines of the MTL file
+    :type lines:
+        List or file object
+
+    :returns:
+        (Dictionary) the groups and fields
+    """
+    root = {}
+    stack = [root]
+
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+
+        key = key.strip()
+        value = value.strip()
+
+        if key == 'GROUP':
+            stack[-1][value] = {}
+            stack.append(stack[-1][value])
+        elif key == 'END_GROUP':
+            if len(stack) > 1:
+                stack.pop()
+        else:
+            stack[-1][key] = parse_value(value)
+
+    return root
+
+
+class Metadata(object):
+    """
+    Metadata of a scene read from its MTL file.
+
+    Fields can be read by name with metadata['CLOUD_COVER'] wherever they are in the groups of
+    the file, and the values needed for image processing have accessors.
+
+    :param groups:
+        The groups of the MTL file, as returned by parse_mtl
+    :type groups:
+        Dictionary
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.fields = {}
+        self._index(groups)
+
+    def _index(self, group):
+        for key, value in group.items():
+            if isinstance(value, dict):
+                self._index(value)
+            else:
+                self.fields[key] = value
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    @property
+    def cloud_cover(self):
+        return self.get('CLOUD_COVER')
+
+    @property
+    def sun_elevation(self):
+        return self.get('SUN_ELEVATION')
+
+    @property
+    def sun_azimuth(self):
+        return self.get('SUN_AZIMUTH')
+
+    @property
+    def earth_sun_distance(self):
+        return self.get('EARTH_SUN_DISTANCE')
+
+    def reflectance(self, band):
+        """ Returns the multiplicative and additive factors that convert the DNs of a band to
+        top of atmosphere reflectance, or None if the band has none.
+
+        :param band:
+            The band number
+        :type band:
+            int
+
+        :returns:
+            Tuple
+        """
+        mult = self.get('REFLECTANCE_MULT_BAND_%s' % band)
+        add = self.get('REFLECTANCE_ADD_BAND_%s' % band)
+
+        if mult is None or add is None:
+            return None
+
+        return mult, add
+
+    def radiance(self, band):
+        """ Returns the multiplicative and additive factors that convert the DNs of a band to
+        radiance, or None if the band has none.
+
+        :param band:
+            The band number
+        :type band:
+            int
+
+        :returns:
+            Tuple
+        """
+        mult = self.get('RADIANCE_MULT_BAND_%s' % band)
+        add = self.get('RADIANCE_ADD_BAND_%s' % band)
+
+        if mult is None or add is None:
+            return None
+
+        return mult, add
+
+
+def sidecar_path(path):
+    """ Path of the JSON file that stores the parsed metadata of an MTL file """
+    return join(dirname(abspath(path)), get_file(path).replace('_MTL.txt', '') + '_metadata.json')
+
+
+def read_metadata(path, sidecar=True):
+    """ Reads the metadata of a scene from its MTL file.
+
+    The result is kept in memory for the rest of the process and, with sidecar, stored in a
+    JSON file next to the MTL file, so the file is only parsed once. Both are discarded when
+    the size or modification time of the MTL file changes.
+
+    :param path:
+        Path to the MTL file
+    :type path:
+        String
+    :param sidecar:
+        Whether to read and write the JSON sidecar file. Default is True
+    :type sidecar:
+        boolean
+
+    :returns:
+        Metadata
+
+    :raises OSError:
+        If the MTL file does not exist
+    """
+    path = abspath(path)
+    stat = os.stat(path)
+    version = [stat.st_size, stat.st_mtime]
+
+    memo = _memo.get(path)
+    if memo and memo[0] == version:
+        return memo[1]
+
+    stored = read_json(sidecar_path(path)) if sidecar else None
+
+    if stored and stored.get('version') == version:
+        groups = stored['groups']
+    else:
+        with open(path) as mtl:
+            groups = parse_mtl(mtl)
+
+        if sidecar:
+            try:
+                write_json(sidecar_path(path), {'version': version, 'groups': groups})
+            except (IOError, OSError):
+                # The folder may be read only
+                pass
+
+    metadata = Metadata(groups)
+    _memo[path] = (version, metadata)
+
+    return metadata
@@ -0,0 +1,130 @@
+# Multi-scene Mosaic
+# Landsat Util
+# License: CC0 1.0 Universal
+
+from __future__ import print_function, division, absolute_import
+
+import math
+from copy import copy
+
+import numpy
+
+from .decorators import rasterio_decorator, scratch_decorator
+from .image import BaseProcess
+
+
+class Mosaic(BaseProcess):
+    """
+    Mosaics several scenes, e.g. adjacent path/rows, into one color corrected image.
+
+    The scenes are reprojected onto one grid that covers all of them and composited block by
+    block: each pixel comes from the first scene that has data for it. The color correction
+    uses the histogram of the whole mosaic, so the scenes match, and only one block of one
+    scene is held in memory at a time, whatever the number of scenes.
+
+    The mosaic is named after its first scene. Other parameters are the same as BaseProcess
+    and apply to every scene.
+
+    :param paths:
+        Paths of the scenes
+    :type paths:
+        List
+    """
+
+    def __init__(self, paths, bands=None, **kwargs):
+        super(Mosaic, self).__init__(paths[0], copy(bands), **kwargs)
+
+        self.scenes = [self] + [BaseProcess(path, copy(bands), **kwargs) for path in paths[1:]]
+        self.block_size = self.block_size or 1024
+
+    @scratch_decorator
+    @rasterio_decorator
+    def run(self):
+        """ Executes the mosaic processing.
+
+        :returns:
+            (String) the path to the processed image
+        """
+        self.output('Mosaic of %s scenes started for bands %s' % (len(self.scenes), '-'.join(map(str, self.bands))),
+                    normal=True, arrow=True)
+
+        image_data = self._get_image_data()
+
+        rasterio_options = {
+            'driver': 'GTiff',
+            'width': image_data['shape'][1],
+            'height': image_data['shape'][0],
+            'count': 3,
+            'dtype': numpy.uint8,
+            'nodata': 0,
+            'transform': image_data['dst_transform'],
+            'photometric': 'RGB',
+            'crs': self.dst_crs
+        }
+
+        return self._write_blocks(image_data, 'mosaic_bands_%s' % "".join(map(str, self.bands)), **rasterio_options)
+
+    def _get_image_data(self):
+        """ Returns the grid that covers all scenes, with the smallest pixel size of the scenes """
+        self.scene_bounds = []
+        x_pixel = y_pixel = None
+
+        for scene in self.scenes:
+            image_data = BaseProcess._get_image_data(scene)
+            transform = image_data['dst_transform']
+            shape = image_data['shape']
+
+            self.scene_bounds.append((transform[0], transform[3] + transform[5] * shape[0],
+                                      transform[0] + transform[1] * shape[1], transform[3]))
+            x_pixel = min(x_pixel or transform[1], transform[1])
+            y_pixel = min(y_pixel or -transform[5], -transform[5])
+
+        left = min(bounds[0] for bounds in self.scene_bounds)
+        bottom = min(bounds[1] for bounds in self.scene_bounds)
+        right = max(bounds[2] for bounds in self.scene_bounds)
+        top = max(bounds[3] for bounds in self.scene_bounds)
+
+        return {
+            'shape': (int(math.ceil((top - bottom) / y_pixel)), int(math.ceil((right - left) / x_pixel))),
+            'dst_transform': (left, x_pixel, 0.0, top, 0.0, -y_pixel)
+        }
+
+    def _calculate_cloud_ice_perc(self):
+        """ Returns the mean cloud and snow coverage of the scenes """
+        return numpy.mean([BaseProcess._calculate_cloud_ice_perc(scene) for scene in self.scenes])
+
+    def _open_bands(self):
+        """ Opens the bands of every scene, scene after scene """
+        return [src for scene in self.scenes for src in BaseProcess._open_bands(scene)]
+
+    def _warp_block(self, proj_data, srcs, window, dtype=numpy.uint16):
+        """ Reprojects the scenes that overlap the window and composites them. Pixels that are
+        nodata in the composite are filled from the next scene.
+        """
+        transform = proj_data['dst_transform']
+        left, top = transform[0] + window[1][0] * transform[1], transform[3] + window[0][0] * transform[5]
+        right, bottom = transform[0] + window[1][1] * transform[1], transform[3] + window[0][1] * transform[5]
+
+        count = len(self.bands)
+        blocks = None
+
+        for i, scene in enumerate(self.scenes):
+            scene_left, scene_bottom, scene_right, scene_top = self.scene_bounds[i]
+            if scene_left >= right or scene_right <= left or scene_bottom >= top or scene_top <= bottom:
+                continue
+
+            scene_blocks = BaseProcess._warp_block(scene, proj_data, srcs[i * count:(i + 1) * count], window, dtype)
+
+            if blocks is None:
+                blocks = scene_blocks
+                continue
+
+            empty = blocks[0] == 0
+            for block, scene_block in zip(blocks, scene_blocks):
+                numpy.copyto(block, scene_block, where=empty)
+
+        if blocks is None:
+            shape = (window[0][1] - window[0][0], window[1][1] - window[1][0])
+            blocks = [numpy.zeros(shape, dtype=dtype) for band in self.bands]
+
+        return blocks
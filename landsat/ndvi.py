@@ -6,12 +6,15 @@ import rasterio
 import numpy
 
 from . import settings
-from .decorators import rasterio_decorator
+from .decorators import rasterio_decorator, scratch_decorator
 from .image import BaseProcess
 
 
 class NDVI(BaseProcess):
 
+    # Parsed colormaps shared by all instances, keyed by the path of the colormap file
+    colormaps = {}
+
     def __init__(self, path, bands=None, **kwargs):
         bands = [4, 5]
         self._read_cmap()
@@ -21,12 +24,28 @@ class NDVI(BaseProcess):
         """
         reads the colormap from a text file given in settings.py.
         See colormap_cubehelix.txt. File must contain 256 RGB values
+
+        The file is only parsed once, the colormap is then reused by other instances.
+        """
+
+        if settings.COLORMAP not in self.colormaps:
+            self.colormaps[settings.COLORMAP] = self._parse_cmap(settings.COLORMAP)
+
+        colormap, self.palette = self.colormaps[settings.COLORMAP]
+        self.cmap = dict(colormap)
+
+    def _parse_cmap(self, path):
+        """
+        Parses a colormap file.
+
+        :returns:
+            (Tuple) the colormap as a dictionary and as a (256, 3) uint8 palette array
         """
 
         try:
             i = 0
             colormap = {0: (0, 0, 0)}
-            with open(settings.COLORMAP) as cmap:
+            with open(path) as cmap:
                 lines = cmap.readlines()
                 for line in lines:
                     if i == 0 and 'mode = ' in line:
@@ -47,8 +66,14 @@ class NDVI(BaseProcess):
         except IOError:
             pass
 
-        self.cmap = {k: v[:4] for k, v in colormap.items()}
+        palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+        for k, v in colormap.items():
+            if k < 256:
+                palette[k] = v[:3]
+
+        return colormap, palette
 
+    @scratch_decorator
     @rasterio_decorator
     def run(self):
         """
@@ -56,74 +81,112 @@ class NDVI(BaseProcess):
         """
         self.output("* NDVI processing started.", normal=True)
 
-        bands = self._read_bands()
         image_data = self._get_image_data()
 
+        if self.block_size:
+            return self._write_blocks(image_data, 'NDVI')
+
+        bands = self._read_bands()
+
         new_bands = []
         for i in range(0, 2):
-            new_bands.append(numpy.empty(image_data['shape'], dtype=numpy.float32))
+            new_bands.append(self._allocate(image_data['shape'], numpy.float32))
 
         self._warp(image_data, bands, new_bands)
 
         # Bands are no longer needed
         del bands
 
-        calc_band = numpy.true_divide((new_bands[1] - new_bands[0]), (new_bands[1] + new_bands[0]))
-
-        output_band = numpy.rint((calc_band + 1) * 255 / 2).astype(numpy.uint8)
+        output_band = self._calculate_ndvi(new_bands)
 
         output_file = join(self.dst_path, self._filename(suffix='NDVI'))
 
         return self.write_band(output_band, output_file, image_data)
 
+    def _calculate_ndvi(self, bands):
+        """ Returns the NDVI of the red and near infrared bands scaled to 0-255 """
+        calc_band = numpy.true_divide((bands[1] - bands[0]), (bands[1] + bands[0]))
+
+        return numpy.rint((calc_band + 1) * 255 / 2).astype(numpy.uint8)
+
+    @rasterio_decorator
+    def _write_blocks(self, image_data, suffix, **kwargs):
+        """ Calculates and writes the NDVI block by block """
+        srcs = self._open_bands()
+
+        output_file = join(self.dst_path, self._filename(suffix=suffix))
+
+        self.output("Calculating NDVI", normal=True, arrow=True)
+        with self.open_output(output_file, image_data) as output:
+            for window in self._block_windows(image_data['shape']):
+                output_band = self._calculate_ndvi(self._warp_block(image_data, srcs, window, numpy.float32))
+                self.write_block(output, output_band, window)
+
+        for src in srcs:
+            src.close()
+
+        self.output("Writing to file", normal=True, color='green', indent=1)
+        return self._finish_output(output_file)
+
+    def open_output(self, output_file, image_data):
+        """ Opens the output file for writing """
+        return self._create_output(output_file, driver='GTiff',
+                                   width=image_data['shape'][1],
+                                   height=image_data['shape'][0],
+                                   count=1,
+                                   dtype=numpy.uint8,
+                                   nodata=0,
+                                   transform=image_data['dst_transform'],
+                                   crs=self.dst_crs)
+
+    def write_block(self, output, output_band, window=None):
+        """ Writes the NDVI values of the given window to the output """
+        output.write_band(1, output_band, window=window)
+
     def write_band(self, output_band, output_file, image_data):
 
         # from http://publiclab.org/notes/cfastie/08-26-2014/new-ndvi-colormap
-        with rasterio.open(output_file, 'w', driver='GTiff',
-                           width=image_data['shape'][1],
-                           height=image_data['shape'][0],
-                           count=1,
-                           dtype=numpy.uint8,
-                           nodata=0,
-                           transform=image_data['dst_transform'],
-                           crs=self.dst_crs) as output:
-
-            output.write_band(1, output_band)
+        with self.open_output(output_file, image_data) as output:
+            self.write_block(output, output_band)
 
             self.output("Writing to file", normal=True, color='green', indent=1)
-        return output_file
+        return self._finish_output(output_file)
 
 
 class NDVIWithManualColorMap(NDVI):
 
-    def manual_colormap(self, n, i):
-        return self.cmap[n][i]
+    @rasterio_decorator
+    def _write_blocks(self, image_data, suffix, **kwargs):
+        with rasterio.drivers(GDAL_TIFF_INTERNAL_MASK=True):
+            return super(NDVIWithManualColorMap, self)._write_blocks(image_data, suffix, **kwargs)
+
+    def open_output(self, output_file, image_data):
+        """ Opens the output file for writing """
+        return self._create_output(output_file, driver='GTiff',
+                                   width=image_data['shape'][1],
+                                   height=image_data['shape'][0],
+                                   count=3,
+                                   dtype=numpy.uint8,
+                                   nodata=0,
+                                   photometric='RGB',
+                                   transform=image_data['dst_transform'],
+                                   crs=self.dst_crs)
+
+    def write_block(self, output, output_band, window=None):
+        """ Applies the colormap to the NDVI values of the given window and writes them to the output """
+        # Entry 0 of the palette (nodata) is always black
+        for i in range(3):
+            output.write_band(i + 1, numpy.take(self.palette[:, i], output_band), window=window)
 
     def write_band(self, output_band, output_file, image_data):
         # colormaps will overwrite our transparency masks so we will manually
         # create three RGB bands
 
         self.output("Applying ColorMap", normal=True, arrow=True)
-        self.cmap[0] = (0, 0, 0, 255)
-
-        v_manual_colormap = numpy.vectorize(self.manual_colormap, otypes=[numpy.uint8])
-        rgb_bands = []
-        for i in range(3):
-            rgb_bands.append(v_manual_colormap(output_band, i))
 
         with rasterio.drivers(GDAL_TIFF_INTERNAL_MASK=True):
-            with rasterio.open(output_file, 'w', driver='GTiff',
-                               width=image_data['shape'][1],
-                               height=image_data['shape'][0],
-                               count=3,
-                               dtype=numpy.uint8,
-                               nodata=0,
-                               photometric='RGB',
-                               transform=image_data['dst_transform'],
-                               crs=self.dst_crs) as output:
-
-                for i in range(3):
-                    output.write_band(i + 1, rgb_bands[i])
+            with self.open_output(output_file, image_data) as output:
+                self.write_block(output, output_band)
 
             self.output("Writing to file", normal=True, color='green', indent=1)
-        return output_file
+            return self._finish_output(output_file)
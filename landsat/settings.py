@@ -28,5 +28,48 @@ LANDSAT_DIR = join(HOME_DIR, 'landsat')
 DOWNLOAD_DIR = join(LANDSAT_DIR, 'downloads')
 PROCESSED_IMAGE = join(LANDSAT_DIR, 'processed')
 
+# Maximum number of files downloaded at the same time from each source
+DOWNLOAD_LIMITS = {
+    's3': 8,
+    'google': 4,
+    'usgs': 2
+}
+
+# Seconds to wait for a download server to respond
+DOWNLOAD_TIMEOUT = 60
+
+# Number of times an interrupted download is resumed before giving up
+DOWNLOAD_RETRIES = 3
+
+# Files of at least twice DOWNLOAD_SEGMENT_SIZE bytes are downloaded in up to DOWNLOAD_SEGMENTS
+# byte ranges at the same time
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 ** 2
+DOWNLOAD_SEGMENTS = 8
+
+# Persistent caches
+CACHE_DIR = join(LANDSAT_DIR, 'cache')
+GRID_CACHE = join(CACHE_DIR, 'grids')
+CLIP_CACHE = join(CACHE_DIR, 'clips')
+RESULT_CACHE = join(CACHE_DIR, 'results')
+DOWNLOAD_CACHE = join(CACHE_DIR, 'downloads')
+
+# Size budget of the clip cache in bytes
+CLIP_CACHE_SIZE = 2 * 1024 ** 3
+
+# Size budget of the download cache in bytes
+DOWNLOAD_CACHE_SIZE = 20 * 1024 ** 3
+
+# Creation options of the processed GeoTIFFs. 'overviews' are the decimation factors of the
+# internal overviews. Images with overviews are written with the cloud optimized GeoTIFF layout.
+# zstd requires GDAL 2.3 or newer.
+OUTPUT_PROFILES = {
+    'default': {},
+    'deflate': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate', 'predictor': 2},
+    'lzw': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'lzw', 'predictor': 2},
+    'zstd': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'zstd', 'predictor': 2},
+    'cog': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate', 'predictor': 2,
+            'overviews': [2, 4, 8, 16, 32]},
+}
+
 # Colormap File
 COLORMAP = join(abspath(dirname(__file__)), 'maps', 'colormap_ndvi_cfastie.txt')
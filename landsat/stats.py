@@ -0,0 +1,136 @@
+# Band Statistics
+# Landsat Util
+# License: CC0 1.0 Universal
+
+from __future__ import print_function, division, absolute_import
+
+import numpy
+
+
+# Number of pixels counted at once. numpy.bincount casts its input to intp, so the
+# band is fed in chunks to keep that temporary copy small.
+CHUNK_SIZE = 1048576
+
+
+class Histogram(object):
+    """
+    16-bit histogram of a band.
+
+    Percentiles of uint16 data can be calculated exactly from the histogram, without
+    sorting or copying the band. The histogram can be updated block by block, so the
+    statistics of a scene can be collected without holding the whole band in memory.
+
+    :param counts:
+        An existing array of 65536 counts (optional)
+    :type counts:
+        numpy.ndarray
+    """
+
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else numpy.zeros(65536, dtype=numpy.int64)
+
+    def update(self, band):
+        """ Adds the pixels of a uint16 band or block to the histogram.
+
+        :param band:
+            The band or a block of it
+        :type band:
+            numpy.ndarray
+
+        :returns:
+            The histogram
+        """
+        flat = numpy.ravel(band)
+
+        for start in range(0, flat.size, CHUNK_SIZE):
+            self.counts += numpy.bincount(flat[start:start + CHUNK_SIZE], minlength=65536)
+
+        return self
+
+    def merge(self, other):
+        """ Adds the counts of another histogram, e.g. the histogram of an adjacent scene.
+
+        :param other:
+            Another histogram
+        :type other:
+            Histogram
+
+        :returns:
+            The histogram
+        """
+        self.counts += other.counts
+        return self
+
+    def percentiles(self, qs):
+        """ Returns the percentiles of the valid pixels, that is pixels that are neither 0 (nodata)
+        nor 65535 (saturated). The values are the same as numpy.percentile would return.
+
+        :param qs:
+            Percentiles between 0 and 100
+        :type qs:
+            List
+
+        :returns:
+            List
+        """
+        valid = self.counts.copy()
+        valid[0] = 0
+        valid[65535] = 0
+        cumulative = numpy.cumsum(valid)
+        total = cumulative[-1]
+
+        if total == 0:
+            return [0.0 for q in qs]
+
+        output = []
+        for q in qs:
+            # Same linear interpolation as numpy.percentile
+            rank = q / 100.0 * (total - 1)
+            lower = int(numpy.floor(rank))
+            lower_value = numpy.searchsorted(cumulative, lower + 1)
+
+            if rank == lower:
+                output.append(float(lower_value))
+            else:
+                upper_value = numpy.searchsorted(cumulative, lower + 2)
+                output.append(lower_value + (upper_value - lower_value) * (rank - lower))
+
+        return output
+
+    def value_range(self, low=0):
+        """ Returns the smallest and largest values in the histogram that are greater or equal to low.
+
+        :param low:
+            The lower limit
+        :type low:
+            float
+
+        :returns:
+            Tuple
+        """
+        start = int(numpy.ceil(low))
+        present = numpy.flatnonzero(self.counts[start:])
+
+        if present.size == 0:
+            return (start, 65535)
+
+        return (start + present[0], start + present[-1])
+
+    def cuts(self, low, high):
+        """ Returns the values needed to color correct the band.
+
+        :param low:
+            The low percentile
+        :type low:
+            float
+        :param high:
+            The high percentile
+        :type high:
+            float
+
+        :returns:
+            (Tuple) the low and high percentiles and the range of the pixels above the high percentile
+        """
+        p_low, p_high = self.percentiles([low, high])
+
+        return p_low, p_high, self.value_range(p_high)
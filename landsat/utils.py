@@ -7,6 +7,7 @@ import os
 import sys
 import time
 import re
+import errno
 
 try:
     from io import StringIO
@@ -112,7 +113,8 @@ def create_paired_list(value):
 
 
 def check_create_folder(folder_path):
-    """ Check whether a folder exists, if not the folder is created.
+    """ Check whether a folder exists, if not the folder is created. Threads and processes that
+    create the same folder at the same time do not fail.
 
     :param folder_path:
         Path to the folder
@@ -122,8 +124,11 @@ def check_create_folder(folder_path):
     :returns:
         (String) the path to the folder
     """
-    if not os.path.exists(folder_path):
+    try:
         os.makedirs(folder_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(folder_path):
+            raise
 
     return folder_path
 
@@ -0,0 +1,167 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""Tests for cache"""
+
+import os
+import errno
+import shutil
+import unittest
+import threading
+from tempfile import mkdtemp
+
+from landsat.cache import FileCache, JSONCache, file_lock, fingerprint, link, read_json, write_json
+
+
+class TestCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_folder = mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            shutil.rmtree(cls.temp_folder)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint('LC80030172015001LGN00', [4, 3, 2]),
+                         fingerprint('LC80030172015001LGN00', (4, 3, 2)))
+        self.assertEqual(fingerprint({'a': 1, 'b': 2}), fingerprint({'b': 2, 'a': 1}))
+        self.assertNotEqual(fingerprint('LC80030172015001LGN00', [4, 3, 2]),
+                            fingerprint('LC80030172015001LGN00', [5, 4, 3]))
+
+    def test_json_cache(self):
+        cache = JSONCache(os.path.join(self.temp_folder, 'json'))
+        key = [{'init': 'epsg:32616'}, [0.0, 30.0, 0.0, 0.0, 0.0, -30.0], [100, 100]]
+
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.get(key, 'default'), 'default')
+
+        self.assertEqual(cache.set(key, [1.5, 2.5]), [1.5, 2.5])
+        self.assertEqual(cache.get(key), [1.5, 2.5])
+        self.assertEqual(JSONCache(cache.folder).get(key), [1.5, 2.5])
+
+        # Only the entry itself is left in the folder
+        self.assertEqual(os.listdir(cache.folder), [os.path.basename(cache.path(key))])
+
+    def test_json_file(self):
+        path = os.path.join(self.temp_folder, 'LC80030172015001LGN00_coverage.json')
+
+        self.assertEqual(read_json(path, {}), {})
+        self.assertEqual(write_json(path, {'a': 12.5}), {'a': 12.5})
+        self.assertEqual(read_json(path), {'a': 12.5})
+
+        with open(path, 'w') as f:
+            f.write('{"a": ')
+        self.assertIsNone(read_json(path))
+
+    def write(self, size):
+        def write_file(path):
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+        return write_file
+
+    def test_file_cache(self):
+        cache = FileCache(os.path.join(self.temp_folder, 'files'), 250, '.TIF')
+
+        self.assertIsNone(cache.get('a'))
+        path = cache.add('a', self.write(100))
+        self.assertEqual(path, cache.path('a'))
+        self.assertTrue(path.endswith('.TIF'))
+        self.assertEqual(cache.get('a'), path)
+        self.assertEqual(os.path.getsize(path), 100)
+
+    def test_file_cache_evicts_least_recently_used(self):
+        cache = FileCache(os.path.join(self.temp_folder, 'lru'), 250)
+
+        cache.add('a', self.write(100))
+        cache.add('b', self.write(100))
+        os.utime(cache.path('a'), (1000, 1000))
+        os.utime(cache.path('b'), (2000, 2000))
+
+        # Using a makes b the least recently used entry, without changing the modification time of a
+        cache.get('a')
+        self.assertEqual(os.path.getmtime(cache.path('a')), 1000)
+
+        cache.add('c', self.write(100))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_file_cache_keeps_locked_entries(self):
+        cache = FileCache(os.path.join(self.temp_folder, 'locked'), 250, '.bin')
+
+        cache.add('a', self.write(100))
+        cache.add('b', self.write(100))
+        os.utime(cache.path('a'), (2000, 2000))
+        os.utime(cache.path('b'), (1000, 1000))
+
+        # b is the least recently used entry, but is in use
+        with cache.lock('b'):
+            cache.add('c', self.write(100))
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_file_cache_created_by_threads(self):
+        """ Threads that use a new cache at the same time all create its folder without failing """
+        for run in range(20):
+            folder = os.path.join(self.temp_folder, 'threads', str(run), 'cache')
+            start = threading.Event()
+            errors = []
+
+            def use_cache(key):
+                start.wait()
+                try:
+                    with FileCache(folder, 250).lock(key):
+                        pass
+                    JSONCache(folder).set(key, key)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=use_cache, args=(str(i),)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+
+    def test_file_lock(self):
+        path = os.path.join(self.temp_folder, 'file.lock')
+
+        with file_lock(path) as acquired:
+            self.assertTrue(acquired)
+            with file_lock(path, blocking=False) as acquired:
+                self.assertFalse(acquired)
+
+        with file_lock(path, blocking=False) as acquired:
+            self.assertTrue(acquired)
+
+    def test_file_cache_failed_write(self):
+        cache = FileCache(os.path.join(self.temp_folder, 'failed'), 250)
+
+        def write(path):
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, cache.add, 'a', write)
+        self.assertEqual(os.listdir(cache.folder), [])
+
+    def test_link(self):
+        src = os.path.join(self.temp_folder, 'src.txt')
+        with open(src, 'w') as f:
+            f.write('band')
+
+        dst = link(src, os.path.join(self.temp_folder, 'dst.txt'))
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'band')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""Tests for decompress"""
+
+import io
+import os
+import bz2
+import errno
+import random
+import shutil
+import tarfile
+import unittest
+from os.path import join
+from tempfile import mkdtemp
+
+from landsat.decompress import ParallelBZ2File, find_blocks
+
+
+class TestDecompress(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_folder = mkdtemp()
+
+        # Compressible data that spans several 100k blocks, followed by random bytes
+        rnd = random.Random(0)
+        cls.data = b''.join(bytes(bytearray(rnd.choice(b'landsat') for i in range(1000))) for j in range(500))
+        cls.data += os.urandom(200000)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            shutil.rmtree(cls.temp_folder)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def write(self, name, data):
+        path = join(self.temp_folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        f = ParallelBZ2File(path, processes=3)
+        try:
+            return io.BufferedReader(f).read()
+        finally:
+            f.close()
+
+    def test_find_blocks(self):
+        compressed = bz2.compress(self.data, 1)
+        blocks = find_blocks(compressed)
+
+        self.assertTrue(len(blocks) > 1)
+        self.assertEqual(blocks[0][0], 32)
+        for (start, end), (next_start, next_end) in zip(blocks, blocks[1:]):
+            self.assertEqual(end, next_start)
+
+    def test_read(self):
+        path = self.write('single.bz2', bz2.compress(self.data, 1))
+        self.assertEqual(self.read(path), self.data)
+
+    def test_read_concatenated_streams(self):
+        path = self.write('multi.bz2', bz2.compress(self.data, 9) + bz2.compress(self.data[:12345], 2))
+        self.assertEqual(self.read(path), self.data + self.data[:12345])
+
+    def test_not_bzip2(self):
+        path = self.write('plain.bz2', self.data)
+        self.assertRaises(IOError, ParallelBZ2File, path)
+
+    def test_tar_extraction(self):
+        path = join(self.temp_folder, 'scene.tar.bz')
+        with tarfile.open(path, 'w:bz2') as tar:
+            info = tarfile.TarInfo('scene_B4.TIF')
+            info.size = len(self.data)
+            tar.addfile(info, io.BytesIO(self.data))
+
+        f = ParallelBZ2File(path, processes=2)
+        try:
+            tar = tarfile.open(fileobj=io.BufferedReader(f), mode='r|')
+            for member in tar:
+                self.assertEqual(tar.extractfile(member).read(), self.data)
+            tar.close()
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,8 +10,10 @@ import unittest
 from tempfile import mkdtemp
 
 import mock
+import requests
 
-from landsat.downloader import Downloader, RemoteFileDoesntExist, IncorrectSceneId
+from landsat.downloader import (Downloader, RemoteFileDoesntExist, IncorrectSceneId, IncompleteDownload, fetch,
+                                segment_ranges)
 from landsat.settings import GOOGLE_STORAGE, S3_LANDSAT
 
 
@@ -94,9 +96,31 @@ class TestDownloader(unittest.TestCase):
         test_paths = [self.temp_folder + '/' + self.scene_s3]
         self.assertEqual(test_paths, paths)
 
+    @mock.patch('landsat.downloader.Downloader.probe')
     @mock.patch('landsat.downloader.fetch')
-    def test_fetch(self, mock_fetch):
+    def test_download_concurrent(self, mock_fetch, mock_probe):
+        """ Test that scenes downloaded at the same time are returned in order """
         mock_fetch.return_value = True
+        mock_probe.return_value = {'status': 200, 'size': 100, 'etag': None, 'last_modified': None, 'ranges': False}
+        d = Downloader(download_dir=self.temp_folder, threads=4)
+
+        scenes = [self.scene_s3, self.scene_s3_2, self.scene_2]
+        bands = [4, 3]
+        paths = d.download(scenes, bands=bands)
+        self.assertEqual([os.path.join(self.temp_folder, scene) for scene in scenes], paths)
+        self.assertEqual(bands, [4, 3])
+
+        # Four bands of each scene, including QA and MTL
+        self.assertEqual(mock_fetch.call_count, 12)
+        urls = [call[0][0] for call in mock_fetch.call_args_list]
+        self.assertIn(d.amazon_s3_url(d.scene_interpreter(self.scene_2), 'MTL'), urls)
+
+    @mock.patch('landsat.downloader.Downloader.probe')
+    @mock.patch('landsat.downloader.fetch')
+    def test_fetch(self, mock_fetch, mock_probe):
+        mock_fetch.return_value = True
+        mock_probe.return_value = {'status': 200, 'size': self.scene_size, 'etag': None, 'last_modified': None,
+                                   'ranges': False}
 
         sat = self.d.scene_interpreter(self.scene)
         url = self.d.google_storage_url(sat)
@@ -110,6 +134,182 @@ class TestDownloader(unittest.TestCase):
 
         self.assertAlmostEqual(self.scene_size, size)
 
+    def test_probe(self):
+        """ Test that each url is only requested once """
+        d = Downloader(download_dir=self.temp_folder)
+        response = mock.Mock(status_code=200, headers={'content-length': '1024', 'etag': '"abc"'})
+
+        with mock.patch.object(d.session, 'head', return_value=response) as head:
+            self.assertIsNone(d.remote_file_exists('http://example.com/B4.TIF'))
+            self.assertEqual(d.get_remote_file_size('http://example.com/B4.TIF'), 1024)
+            self.assertEqual(d.probe('http://example.com/B4.TIF'),
+                             {'status': 200, 'size': 1024, 'etag': '"abc"', 'last_modified': None,
+                              'ranges': False})
+            self.assertEqual(head.call_count, 1)
+
+            response.status_code = 404
+            with self.assertRaises(RemoteFileDoesntExist):
+                d.remote_file_exists('http://example.com/B5.TIF')
+            self.assertEqual(head.call_count, 2)
+
+    def test_fetch_resume(self):
+        """ Test that a part file is resumed from its last byte """
+        path = os.path.join(self.temp_folder, 'resume.TIF')
+        with open(path + '.part', 'wb') as f:
+            f.write(b'0123')
+
+        session = mock.Mock()
+        session.get.return_value = mock.Mock(status_code=206, headers={'content-range': 'bytes 4-9/10'})
+        session.get.return_value.iter_content.return_value = [b'456', b'789']
+
+        self.assertEqual(fetch('http://example.com/resume.TIF', path, session, 10, '"abc"'), path)
+        self.assertEqual(session.get.call_args[1]['headers'], {'Range': 'bytes=4-', 'If-Range': '"abc"'})
+        self.assertFalse(os.path.exists(path + '.part'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_fetch_changed_or_incomplete(self):
+        """ Test that the whole file replaces the part file when the server sends it, and that an
+        incomplete download keeps the part file """
+        path = os.path.join(self.temp_folder, 'changed.TIF')
+        with open(path + '.part', 'wb') as f:
+            f.write(b'0123')
+
+        session = mock.Mock()
+        session.get.return_value = mock.Mock(status_code=200, headers={'content-length': '6'})
+        session.get.return_value.iter_content.return_value = [b'abc']
+
+        with self.assertRaises(IncompleteDownload):
+            fetch('http://example.com/changed.TIF', path, session, 10, '"abc"')
+        self.assertFalse(os.path.exists(path))
+        with open(path + '.part', 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+
+        session.get.return_value.iter_content.return_value = [b'abcdef']
+        fetch('http://example.com/changed.TIF', path, session)
+        self.assertEqual(session.get.call_args[1]['headers'], {'Range': 'bytes=3-'})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    @mock.patch('landsat.downloader.Downloader.probe')
+    @mock.patch('landsat.downloader.fetch')
+    def test_fetch_with_cache(self, mock_fetch, mock_probe):
+        """ Test that a file in the download cache is linked instead of downloaded """
+        def download(url, path, *args, **kwargs):
+            with open(path, 'wb') as f:
+                f.write(b'band')
+        mock_fetch.side_effect = download
+        mock_probe.return_value = {'status': 200, 'size': 4, 'etag': '"abc"', 'last_modified': None, 'ranges': False}
+
+        with mock.patch('landsat.settings.DOWNLOAD_CACHE', os.path.join(self.temp_folder, 'cache')):
+            url = 'http://example.com/cached_B4.TIF'
+            for folder in ['job1', 'job2']:
+                path = os.path.join(self.temp_folder, folder)
+                os.mkdir(path)
+                d = Downloader(download_dir=path, cache=True)
+                self.assertEqual(d.fetch(url, path), os.path.join(path, 'cached_B4.TIF'))
+                with open(os.path.join(path, 'cached_B4.TIF'), 'rb') as f:
+                    self.assertEqual(f.read(), b'band')
+
+            self.assertEqual(mock_fetch.call_count, 1)
+
+            # A new version of the file is downloaded again
+            mock_probe.return_value['etag'] = '"def"'
+            os.remove(os.path.join(path, 'cached_B4.TIF'))
+            Downloader(download_dir=path, cache=True).fetch(url, path)
+            self.assertEqual(mock_fetch.call_count, 2)
+
+    @mock.patch('landsat.downloader.Downloader.probe')
+    def test_fetch_retries_dropped_connection(self, mock_probe):
+        """ Test that a connection dropped in the middle of the file is resumed from its last byte """
+        mock_probe.return_value = {'status': 200, 'size': 10, 'etag': '"abc"', 'last_modified': None, 'ranges': False}
+        path = os.path.join(self.temp_folder, 'dropped')
+        os.mkdir(path)
+
+        def dropped(chunk_size):
+            yield b'0123'
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+        first = mock.Mock(status_code=200, headers={'content-length': '10'})
+        first.iter_content.side_effect = dropped
+        second = mock.Mock(status_code=206, headers={'content-range': 'bytes 4-9/10'})
+        second.iter_content.return_value = [b'456789']
+
+        d = Downloader(download_dir=path)
+        with mock.patch.object(d.session, 'get', side_effect=[first, second]) as get:
+            d.fetch('http://example.com/dropped_B4.TIF', path)
+
+        self.assertEqual(get.call_args[1]['headers'], {'Range': 'bytes=4-', 'If-Range': '"abc"'})
+        with open(os.path.join(path, 'dropped_B4.TIF'), 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_fetch_segments_of_changed_file(self):
+        """ Test that the file is probed again when it changed since it was probed """
+        path = os.path.join(self.temp_folder, 'changed_segments')
+        os.mkdir(path)
+        data = b'0123456789abcdefghij'
+
+        def head(url, **kwargs):
+            etag = '"abc"' if head.calls == 0 else '"def"'
+            head.calls += 1
+            return mock.Mock(status_code=200, headers={'content-length': '20', 'etag': etag, 'accept-ranges': 'bytes'})
+        head.calls = 0
+
+        def get(url, headers, **kwargs):
+            if headers['If-Range'] != '"def"':
+                return mock.Mock(status_code=200)
+            start, end = [int(value) for value in headers['Range'][6:].split('-')]
+            response = mock.Mock(status_code=206)
+            response.iter_content.return_value = [data[start:end + 1]]
+            return response
+
+        d = Downloader(download_dir=path)
+        with mock.patch.object(d.session, 'head', side_effect=head), \
+                mock.patch.object(d.session, 'get', side_effect=get), \
+                mock.patch('landsat.settings.DOWNLOAD_SEGMENT_SIZE', 5):
+            d.fetch('http://example.com/changed.tar.bz', path)
+
+        self.assertEqual(head.calls, 2)
+        with open(os.path.join(path, 'changed.tar.bz'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_segment_ranges(self):
+        self.assertEqual(segment_ranges(100, 64, 8), [(0, 99)])
+        self.assertEqual(segment_ranges(100, 30, 8), [(0, 33), (34, 67), (68, 99)])
+        self.assertEqual(segment_ranges(1000, 10, 4), [(0, 249), (250, 499), (500, 749), (750, 999)])
+
+    def test_fetch_segments(self):
+        """ Test that segments are downloaded into their place and that a failed segment is the
+        only one downloaded again """
+        path = os.path.join(self.temp_folder, 'segments.tar.bz')
+        data = b'0123456789abcdefghij'
+        failed = []
+
+        def get(url, headers, **kwargs):
+            start, end = [int(value) for value in headers['Range'][6:].split('-')]
+            response = mock.Mock(status_code=206)
+            response.iter_content.return_value = [data[start:end + 1]]
+            if start == 5 and not failed:
+                failed.append(start)
+                response.iter_content.return_value = [data[start:end]]
+            return response
+
+        session = mock.Mock()
+        session.get.side_effect = get
+        segments = segment_ranges(len(data), 5, 4)
+
+        with self.assertRaises(IncompleteDownload):
+            fetch('http://example.com/segments.tar.bz', path, session, len(data), '"abc"', segments=segments)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(session.get.call_count, 4)
+
+        fetch('http://example.com/segments.tar.bz', path, session, len(data), '"abc"', segments=segments)
+        self.assertEqual(session.get.call_count, 5)
+        self.assertEqual(session.get.call_args[1]['headers'], {'Range': 'bytes=5-9', 'If-Range': '"abc"'})
+        self.assertEqual(os.listdir(self.temp_folder).count('segments.tar.bz.segments.json'), 0)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
     def test_google_storage_url(self):
         sat = self.d.scene_interpreter(self.scene)
 
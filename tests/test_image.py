@@ -3,16 +3,22 @@
 
 """Tests for image processing"""
 
+import os
 from os.path import join, abspath, dirname, exists
 import errno
 import shutil
 import unittest
 from tempfile import mkdtemp
 
+import mock
+import numpy
 import rasterio
 from rasterio.warp import transform_bounds
+from skimage.util import img_as_ubyte
 
 from landsat.image import Simple, PanSharpen
+from landsat.metadata import Metadata
+from landsat.mosaic import Mosaic
 from landsat.ndvi import NDVI, NDVIWithManualColorMap
 
 
@@ -66,6 +72,46 @@ class TestProcess(unittest.TestCase):
         for val, exp in zip(get_bounds(path), bounds):
             self.assertAlmostEqual(val, exp, 2)
 
+    def test_simple_with_clip_cache(self):
+
+        bounds = [-87.48138427734375, 30.700515832683923, -87.43331909179688, 30.739475058679485]
+        with mock.patch('landsat.settings.CLIP_CACHE', join(self.temp_folder, 'clips')):
+            p = Simple(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, bounds=bounds,
+                       clip_cache=True)
+            self.assertEqual(len(os.listdir(join(self.temp_folder, 'clips'))), 4)
+
+            with mock.patch.object(Simple, '_clip_band') as mock_clip_band:
+                p = Simple(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, bounds=bounds,
+                           clip_cache=True)
+                self.assertFalse(mock_clip_band.called)
+
+            path = p.run()
+            self.assertTrue(exists(path))
+            for val, exp in zip(get_bounds(path), bounds):
+                self.assertAlmostEqual(val, exp, 2)
+
+    def test_simple_with_virtual_clip(self):
+
+        bounds = [-87.48138427734375, 30.700515832683923, -87.43331909179688, 30.739475058679485]
+        with mock.patch.object(Simple, 'clip') as mock_clip:
+            p = Simple(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, bounds=bounds,
+                       virtual_clip=True)
+            self.assertFalse(mock_clip.called)
+        path = p.run()
+        self.assertTrue(exists(path))
+        for val, exp in zip(get_bounds(path), bounds):
+            self.assertAlmostEqual(val, exp, 2)
+
+    def test_pansharpen_with_virtual_clip(self):
+
+        bounds = [-87.48138427734375, 30.700515832683923, -87.43331909179688, 30.739475058679485]
+        p = PanSharpen(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, bounds=bounds,
+                       virtual_clip=True)
+        path = p.run()
+        self.assertTrue(exists(path))
+        for val, exp in zip(get_bounds(path), bounds):
+            self.assertAlmostEqual(val, exp, 2)
+
     def test_simple_with_intersecting_bounds_clip(self):
 
         bounds = [-87.520515832683923, 30.700515832683923, -87.43331909179688, 30.739475058679485]
@@ -96,10 +142,128 @@ class TestProcess(unittest.TestCase):
         self.path = join(self.base_dir, 'samples', 'test')
         self.assertTrue(exists(p.run()))
 
+    def test_simple_with_grid_cache(self):
+
+        with mock.patch('landsat.settings.GRID_CACHE', join(self.temp_folder, 'grids')):
+            p = Simple(path=self.landsat_image, dst_path=self.temp_folder, grid_cache=True)
+            expected = p._get_boundaries(p._get_image_data(), p._get_image_data()['shape'])
+
+            self.assertEqual(p._get_image_data()['dst_transform'], expected)
+            self.assertEqual(len(os.listdir(join(self.temp_folder, 'grids'))), 1)
+            self.assertTrue(exists(p.run()))
+
+    def test_cloud_ice_perc_is_cached(self):
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder)
+        perc = p._calculate_cloud_ice_perc()
+        self.assertTrue(exists(join(p.scene_path, p.scene + '_coverage.json')))
+
+        with mock.patch.object(Simple, '_qa_coverage') as mock_coverage:
+            self.assertEqual(Simple(path=self.landsat_image, dst_path=self.temp_folder)._calculate_cloud_ice_perc(),
+                             perc)
+            self.assertFalse(mock_coverage.called)
+
+        decimated = Simple(path=self.landsat_image, dst_path=self.temp_folder, qa_decimation=2)
+        self.assertAlmostEqual(decimated._calculate_cloud_ice_perc(), perc, delta=5)
+
+        # The coverage is still returned when the sidecar file cannot be written
+        with mock.patch('landsat.image.write_json', side_effect=OSError(errno.EACCES, 'Permission denied')):
+            decimated = Simple(path=self.landsat_image, dst_path=self.temp_folder, qa_decimation=4)
+            self.assertAlmostEqual(decimated._calculate_cloud_ice_perc(), perc, delta=5)
+
+    def test_extract_in_daemon_process(self):
+        """ Worker processes of process_images cannot start the parallel decompression pool """
+        p = Simple.__new__(Simple)
+        p.unzip_processes = 4
+
+        with mock.patch('landsat.image.multiprocessing.current_process', return_value=mock.Mock(daemon=True)), \
+                mock.patch('landsat.image.ParallelBZ2File') as mock_reader, \
+                mock.patch('landsat.image.tarfile.open'), \
+                mock.patch.object(Simple, '_extract_tar') as mock_extract_tar:
+            p._extract('LC80030032014142LGN00.tar.bz', self.temp_folder)
+
+        self.assertFalse(mock_reader.called)
+        self.assertTrue(mock_extract_tar.called)
+
+    def test_simple_with_selective_unzip(self):
+
+        p = Simple(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, force_unzip=True,
+                   selective_unzip=True)
+        self.assertEqual(p._missing_members(p.scene_path, p._required_members(p.scene)), [])
+        self.assertTrue(exists(p.run()))
+
+    def test_color_correction_lut(self):
+
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder)
+        with rasterio.drivers():
+            band = rasterio.open(p.bands_path[0]).read_band(1)
+
+        cuts = p._color_cuts([band], 0, 10.0)[0]
+        numpy.testing.assert_array_equal(p._correct_band(band, 4, 0, 10.0, cuts),
+                                         img_as_ubyte(p._color_correction(band, 4, 0, 10.0, cuts)))
+
     def test_pansharpen(self):
         p = PanSharpen(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder)
         self.assertTrue(exists(p.run()))
 
+    def test_pansharpen_upsample(self):
+        p = PanSharpen.__new__(PanSharpen)
+        band = numpy.array([[400, 800], [1200, 1600]], dtype=numpy.uint16)
+        output = numpy.zeros((4, 4), dtype=numpy.uint16)
+
+        expected = [[225, 375, 525, 450],
+                    [450, 700, 900, 750],
+                    [750, 1100, 1300, 1050],
+                    [675, 975, 1125, 900]]
+        numpy.testing.assert_array_equal(p._upsample(band, output, rows=1), expected)
+
+    def test_pansharpen_brovey(self):
+        p = PanSharpen.__new__(PanSharpen)
+        p.band8 = 3
+        bands = [numpy.array([[100, 0], [30000, 7]], dtype=numpy.uint16),
+                 numpy.array([[100, 0], [30000, 7]], dtype=numpy.uint16),
+                 numpy.array([[200, 0], [30000, 7]], dtype=numpy.uint16),
+                 numpy.array([[800, 500], [60000, 10]], dtype=numpy.uint16)]
+
+        rgb = p._brovey(bands, rows=1)[:3]
+        numpy.testing.assert_array_equal(rgb[0], [[200, 0], [20000, 3]])
+        numpy.testing.assert_array_equal(rgb[2], [[400, 0], [20000, 3]])
+
+    def test_pansharpen_brovey_bright_bands(self):
+        """ The sum of bright rgb bands is above 65535 and must not wrap around """
+        p = PanSharpen.__new__(PanSharpen)
+        p.band8 = 3
+        bands = [numpy.array([[24000, 65535]], dtype=numpy.uint16),
+                 numpy.array([[25000, 65535]], dtype=numpy.uint16),
+                 numpy.array([[23000, 65535]], dtype=numpy.uint16),
+                 numpy.array([[36000, 65535]], dtype=numpy.uint16)]
+
+        rgb = p._brovey(bands)[:3]
+        numpy.testing.assert_array_equal(rgb[0], [[12000, 21845]])
+        numpy.testing.assert_array_equal(rgb[1], [[12500, 21845]])
+        numpy.testing.assert_array_equal(rgb[2], [[11500, 21845]])
+
+    def test_to_reflectance(self):
+        p = Simple.__new__(Simple)
+        p.bands = [4, 5]
+        p.threads = 1
+        p._read_metadata = lambda: Metadata({'SUN_ELEVATION': 30.0,
+                                             'REFLECTANCE_MULT_BAND_4': 2e-05, 'REFLECTANCE_ADD_BAND_4': -0.1,
+                                             'REFLECTANCE_MULT_BAND_5': 2e-05, 'REFLECTANCE_ADD_BAND_5': -0.1})
+
+        dn = numpy.array([[0, 5000, 10000], [65535, 20000, 3000]], dtype=numpy.uint16)
+        uint16_band, float_band = p._to_reflectance([dn.copy(), dn.astype(numpy.float32)], rows=1)
+
+        numpy.testing.assert_array_equal(uint16_band, [[0, 1, 10000], [65535, 30000, 1]])
+        numpy.testing.assert_allclose(float_band, [[0, 0, 0.2], [2.4214, 0.6, -0.08]], atol=1e-5)
+
+    def test_simple_with_toa(self):
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder, toa=True)
+        self.assertTrue(exists(p.run()))
+
+    def test_ndvi_with_toa_and_blocks(self):
+        p = NDVI(path=self.landsat_image, dst_path=self.temp_folder, toa=True, block_size=256)
+        self.assertTrue(exists(p.run()))
+
     def test_pansharpen_with_clip(self):
         """ test with pansharpen and clipping """
 
@@ -111,6 +275,53 @@ class TestProcess(unittest.TestCase):
         for val, exp in zip(get_bounds(path), bounds):
             self.assertAlmostEqual(val, exp, 2)
 
+    def test_simple_with_blocks(self):
+
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder, block_size=256)
+        self.assertTrue(exists(p.run()))
+
+    def test_simple_with_blocks_and_clip(self):
+
+        bounds = [-87.48138427734375, 30.700515832683923, -87.43331909179688, 30.739475058679485]
+        p = Simple(path=self.landsat_image, bands=[1, 2, 3], dst_path=self.temp_folder,
+                   bounds=bounds, block_size=256)
+        path = p.run()
+        self.assertTrue(exists(path))
+        for val, exp in zip(get_bounds(path), bounds):
+            self.assertAlmostEqual(val, exp, 2)
+
+    def test_pansharpen_with_blocks(self):
+        p = PanSharpen(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, block_size=256)
+        self.assertTrue(exists(p.run()))
+
+    def test_pansharpen_with_scratch_dir(self):
+        scratch = join(self.temp_folder, 'scratch')
+        p = PanSharpen(path=self.landsat_image, bands=[4, 3, 2], dst_path=self.temp_folder, scratch_dir=scratch)
+        self.assertTrue(exists(p.run()))
+        self.assertEqual(os.listdir(scratch), [])
+
+    def test_simple_with_blocks_and_scratch_dir(self):
+        scratch = join(self.temp_folder, 'scratch')
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder, block_size=256, scratch_dir=scratch)
+        self.assertTrue(exists(p.run()))
+        self.assertEqual(os.listdir(scratch), [])
+
+    def test_simple_with_cog_profile(self):
+        p = Simple(path=self.landsat_image, dst_path=self.temp_folder, output_profile='cog')
+        path = p.run()
+        self.assertTrue(exists(path))
+        self.assertFalse(exists(path + '.tmp'))
+        with rasterio.open(path) as src:
+            self.assertEqual(src.tags(ns='IMAGE_STRUCTURE')['COMPRESSION'], 'DEFLATE')
+            self.assertEqual(src.block_shapes[0], (512, 512))
+
+    def test_ndvi_with_manual_colormap_blocks_and_lzw_profile(self):
+        p = NDVIWithManualColorMap(path=self.landsat_image, dst_path=self.temp_folder, block_size=256,
+                                   output_profile='lzw')
+        path = p.run()
+        with rasterio.open(path) as src:
+            self.assertEqual(src.tags(ns='IMAGE_STRUCTURE')['COMPRESSION'], 'LZW')
+
     def test_ndvi(self):
 
         p = NDVI(path=self.landsat_image, dst_path=self.temp_folder)
@@ -130,3 +341,45 @@ class TestProcess(unittest.TestCase):
 
         p = NDVIWithManualColorMap(path=self.landsat_image, dst_path=self.temp_folder)
         self.assertTrue(exists(p.run()))
+
+    def test_ndvi_with_blocks(self):
+
+        p = NDVI(path=self.landsat_image, dst_path=self.temp_folder, block_size=256)
+        self.assertTrue(exists(p.run()))
+
+    def test_ndvi_with_manual_colormap_and_blocks(self):
+
+        p = NDVIWithManualColorMap(path=self.landsat_image, dst_path=self.temp_folder, block_size=256)
+        self.assertTrue(exists(p.run()))
+
+    def test_ndvi_colormap_is_parsed_once(self):
+
+        p1 = NDVIWithManualColorMap(path=self.landsat_image, dst_path=self.temp_folder)
+        p2 = NDVIWithManualColorMap(path=self.landsat_image, dst_path=self.temp_folder)
+        self.assertIs(p1.palette, p2.palette)
+        self.assertEqual(p1.palette.shape, (256, 3))
+        self.assertEqual(tuple(p1.palette[0]), (0, 0, 0))
+
+    def test_mosaic(self):
+
+        p = Mosaic([self.landsat_image, self.landsat_image], dst_path=self.temp_folder, block_size=256)
+        single = Simple(path=self.landsat_image, dst_path=self.temp_folder)._get_image_data()
+        image_data = p._get_image_data()
+
+        self.assertEqual(image_data['shape'], single['shape'])
+        for val, exp in zip(image_data['dst_transform'], single['dst_transform']):
+            self.assertAlmostEqual(val, exp)
+
+        path = p.run()
+        self.assertTrue(exists(path))
+        self.assertIn('mosaic_bands_432', path)
+
+    def test_mosaic_block_outside_scenes(self):
+
+        p = Mosaic([self.landsat_image], dst_path=self.temp_folder, block_size=256)
+        p.scene_bounds = [(0.0, 0.0, 10.0, 10.0)]
+        blocks = p._warp_block({'dst_transform': (100.0, 1.0, 0.0, 100.0, 0.0, -1.0)}, [], ((0, 2), (0, 3)))
+
+        self.assertEqual(len(blocks), 3)
+        self.assertFalse(blocks[0].any())
+        self.assertEqual(blocks[0].shape, (2, 3))
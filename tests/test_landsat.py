@@ -3,12 +3,14 @@
 
 """Tests for landsat"""
 
+import os
 import json
 import unittest
 import subprocess
 import errno
 import shutil
 from os.path import join
+from tempfile import mkdtemp
 
 from jsonschema import validate
 import mock
@@ -17,6 +19,17 @@ import landsat.landsat as landsat
 from tests import geojson_schema
 
 
+def process_scene(path, bands, **kwargs):
+    """ Stands for process_image in the worker processes of process_images """
+    if path == 'killed':
+        os._exit(9)
+    if path == 'corrupt':
+        raise ValueError('Corrupt file')
+    if path == 'large':
+        return len(bytearray(8 * 1024 ** 3))
+    return path + '.TIF'
+
+
 class TestLandsat(unittest.TestCase):
 
     @classmethod
@@ -96,7 +109,8 @@ class TestLandsat(unittest.TestCase):
 
         args = ['download', 'LC80010092015051LGN00', '-b', '11,', '-d', self.mock_path]
         output = landsat.main(self.parser.parse_args(args))
-        mock_downloader.assert_called_with(download_dir=self.mock_path, usgs_pass=None, usgs_user=None)
+        mock_downloader.assert_called_with(download_dir=self.mock_path, usgs_pass=None, usgs_user=None,
+                                           threads=1, cache=False)
         mock_downloader.return_value.download.assert_called_with(['LC80010092015051LGN00'], [11])
         self.assertEquals(output, ['Download Completed', 0])
 
@@ -107,7 +121,8 @@ class TestLandsat(unittest.TestCase):
 
         args = ['download', 'LC80010092015051LGN00', '-d', self.mock_path]
         output = landsat.main(self.parser.parse_args(args))
-        mock_downloader.assert_called_with(download_dir=self.mock_path, usgs_pass=None, usgs_user=None)
+        mock_downloader.assert_called_with(download_dir=self.mock_path, usgs_pass=None, usgs_user=None,
+                                           threads=1, cache=False)
         mock_downloader.return_value.download.assert_called_with(['LC80010092015051LGN00'], None)
         self.assertEquals(output, ['Download Completed', 0])
 
@@ -140,7 +155,9 @@ class TestLandsat(unittest.TestCase):
         args = ['download', 'LC80010092015051LGN00', 'LC80470222014354LGN00', '-b', '432', '-d', self.mock_path, '-p']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432',
-                                        False, False, False, False, False, bounds=None)
+                                        False, False, False, False, False, bounds=None, threads=1,
+                                        selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
         # Call with force unzip flag
@@ -148,7 +165,8 @@ class TestLandsat(unittest.TestCase):
                 self.mock_path, '-p', '--force-unzip']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432', False, False, False,
-                                        True, False, bounds=None)
+                                        True, False, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
         # Call with pansharpen
@@ -156,7 +174,8 @@ class TestLandsat(unittest.TestCase):
                 self.mock_path, '-p', '--pansharpen']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432', False, True, False,
-                                        False, False, bounds=None)
+                                        False, False, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
         # Call with pansharpen and clipping
@@ -164,7 +183,9 @@ class TestLandsat(unittest.TestCase):
                 self.mock_path, '-p', '--pansharpen', '--clip', '"-180,-180,0,0"']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432', False, True, False,
-                                        False, False, bounds=[-180.0, -180.0, 0.0, 0.0])
+                                        False, False, bounds=[-180.0, -180.0, 0.0, 0.0], threads=1,
+                                        selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
         # Call with ndvi
@@ -172,7 +193,8 @@ class TestLandsat(unittest.TestCase):
                 self.mock_path, '-p', '--ndvi']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432', False, False, True,
-                                        False, False, bounds=None)
+                                        False, False, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
         # Call with ndvigrey
@@ -180,7 +202,8 @@ class TestLandsat(unittest.TestCase):
                 self.mock_path, '-p', '--ndvigrey']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80470222014354LGN00', '432', False, False, False,
-                                        False, True, bounds=None)
+                                        False, True, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF", 0])
 
     @mock.patch('landsat.landsat.Uploader')
@@ -197,7 +220,8 @@ class TestLandsat(unittest.TestCase):
         output = landsat.main(self.parser.parse_args(args))
         # mock_downloader.assert_called_with(['LC80010092015051LGN00'], [4, 3, 2])
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, False, False,
-                                        False, False, bounds=None)
+                                        False, False, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         mock_upload.assert_called_with('somekey', 'somesecret', 'this')
         mock_upload.return_value.run.assert_called_with('mybucket', 'image.TIF', 'image.TIF')
         self.assertEquals(output, ['The output is stored at image.TIF', 0])
@@ -213,7 +237,8 @@ class TestLandsat(unittest.TestCase):
                 '-u', '--region', 'whatever']
         output = landsat.main(self.parser.parse_args(args))
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, False, False,
-                                        False, False, bounds=None)
+                                        False, False, bounds=None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ['Could not authenticate with AWS', 1])
 
     @mock.patch('landsat.landsat.process_image')
@@ -225,7 +250,8 @@ class TestLandsat(unittest.TestCase):
         output = landsat.main(self.parser.parse_args(args))
 
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432',
-                                        False, False, False, False, False, None)
+                                        False, False, False, False, False, None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF"])
 
     @mock.patch('landsat.landsat.process_image')
@@ -237,7 +263,9 @@ class TestLandsat(unittest.TestCase):
         output = landsat.main(self.parser.parse_args(args))
 
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432',
-                                        False, False, False, False, False, [-180.0, -180.0, 0.0, 0.0])
+                                        False, False, False, False, False, [-180.0, -180.0, 0.0, 0.0], threads=1,
+                                        selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF"])
 
     @mock.patch('landsat.landsat.process_image')
@@ -249,7 +277,8 @@ class TestLandsat(unittest.TestCase):
         output = landsat.main(self.parser.parse_args(args))
 
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, True, False, False,
-                                        False, None)
+                                        False, None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF"])
 
     @mock.patch('landsat.landsat.process_image')
@@ -261,9 +290,129 @@ class TestLandsat(unittest.TestCase):
         output = landsat.main(self.parser.parse_args(args))
 
         mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, False, True, False,
-                                        False, None)
+                                        False, None, threads=1, selective_unzip=False,
+                                        output_profile='default')
         self.assertEquals(output, ["The output is stored at image.TIF"])
 
+    @mock.patch('landsat.landsat.process_image')
+    def test_process_correct_with_threads(self, mock_process):
+        """Test process command with correct input and multiple threads"""
+        mock_process.return_value = 'image.TIF'
+
+        args = ['process', '--threads', '4', 'path/to/folder/LC80010092015051LGN00']
+        output = landsat.main(self.parser.parse_args(args))
+
+        mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, False, False, False,
+                                        False, None, threads=4, selective_unzip=False,
+                                        output_profile='default')
+        self.assertEquals(output, ["The output is stored at image.TIF"])
+
+    @mock.patch('landsat.landsat.process_image')
+    def test_process_correct_with_output_profile(self, mock_process):
+        """Test process command with correct input and an output profile"""
+        mock_process.return_value = 'image.TIF'
+
+        args = ['process', '--output-profile', 'cog', 'path/to/folder/LC80010092015051LGN00']
+        output = landsat.main(self.parser.parse_args(args))
+
+        mock_process.assert_called_with('path/to/folder/LC80010092015051LGN00', '432', False, False, False, False,
+                                        False, None, threads=1, selective_unzip=False, output_profile='cog')
+        self.assertEquals(output, ["The output is stored at image.TIF"])
+
+    @mock.patch('landsat.landsat.Simple')
+    def test_process_image_with_result_cache(self, mock_simple):
+        """Test that process_image returns the stored image when the input and parameters are the same"""
+        folder = mkdtemp()
+        try:
+            scene = join(folder, 'LC80010092015051LGN00.tar.bz')
+            output = join(folder, 'LC80010092015051LGN00_bands_432.TIF')
+            for path in [scene, output]:
+                with open(path, 'w') as f:
+                    f.write('data')
+            mock_simple.return_value.run.return_value = output
+
+            with mock.patch('landsat.settings.RESULT_CACHE', join(folder, 'results')):
+                self.assertEqual(landsat.process_image(scene, '432', result_cache=True), output)
+                self.assertEqual(landsat.process_image(scene, '432', result_cache=True), output)
+                self.assertEqual(mock_simple.call_count, 1)
+
+                landsat.process_image(scene, '543', result_cache=True)
+                self.assertEqual(mock_simple.call_count, 2)
+
+                # The stored image was changed
+                with open(output, 'w') as f:
+                    f.write('other data')
+                landsat.process_image(scene, '432', result_cache=True)
+                self.assertEqual(mock_simple.call_count, 3)
+
+                # PanSharpen adds band 8 to the bands it is given
+                with mock.patch('landsat.landsat.PanSharpen') as mock_pansharpen:
+                    def pansharpen(path, bands, **kwargs):
+                        bands.append(8)
+                        return mock.Mock(**{'run.return_value': output})
+                    mock_pansharpen.side_effect = pansharpen
+
+                    landsat.process_image(scene, '432', pansharpen=True, block_size=256, result_cache=True)
+                    landsat.process_image(scene, '432', pansharpen=True, block_size=256, result_cache=True)
+                    self.assertEqual(mock_pansharpen.call_count, 1)
+        finally:
+            shutil.rmtree(folder)
+
+    @mock.patch('landsat.landsat.process_image')
+    def test_process_images(self, mock_process):
+        """Test that a failed scene does not stop the batch and results keep the order of the scenes"""
+        def process(path, bands, **kwargs):
+            if path == 'scene2':
+                raise SystemExit(1)
+            if path == 'scene3':
+                raise ValueError('Corrupt file')
+            return path + '.TIF'
+        mock_process.side_effect = process
+
+        results = landsat.process_images(['scene1', 'scene2', 'scene3', 'scene4'], ('432',), {'threads': 2})
+        mock_process.assert_called_with('scene4', '432', threads=2)
+        self.assertEqual(results, [('scene1', 'scene1.TIF', None),
+                                   ('scene2', None, 'exited with code 1'),
+                                   ('scene3', None, 'ValueError: Corrupt file'),
+                                   ('scene4', 'scene4.TIF', None)])
+
+    @mock.patch('landsat.landsat.process_image', side_effect=process_scene)
+    def test_process_images_with_workers(self, mock_process):
+        """Test that scenes processed in worker processes are reported in order, including a killed worker"""
+        results = landsat.process_images(['scene1', 'killed', 'corrupt', 'scene4'], ('432',), workers=2)
+        self.assertEqual(results, [('scene1', 'scene1.TIF', None),
+                                   ('killed', None, 'worker process died with exit code 9'),
+                                   ('corrupt', None, 'ValueError: Corrupt file'),
+                                   ('scene4', 'scene4.TIF', None)])
+
+    @unittest.skipIf(landsat.resource is None, 'The resource module is not available')
+    @mock.patch('landsat.landsat.process_image', side_effect=process_scene)
+    def test_process_images_with_memory_limit(self, mock_process):
+        """Test that a scene that needs more than the memory limit fails alone"""
+        results = landsat.process_images(['scene1', 'large'], ('432',), memory_limit=4096)
+        self.assertEqual(results, [('scene1', 'scene1.TIF', None), ('large', None, 'MemoryError: ')])
+
+    @mock.patch('landsat.landsat.resource', None)
+    @mock.patch('landsat.landsat.Downloader')
+    def test_download_memory_limit_unsupported(self, mock_downloader):
+        """Test that --memory-limit is rejected where the resource module is not available"""
+        args = ['download', 'LC80010092015051LGN00', '-d', self.mock_path, '-p', '--memory-limit', '1024']
+        output = landsat.main(self.parser.parse_args(args))
+        self.assertFalse(mock_downloader.called)
+        self.assertEquals(output, ['--memory-limit is not supported on this platform', 1])
+
+    @mock.patch('landsat.landsat.process_image')
+    @mock.patch('landsat.downloader.fetch')
+    def test_download_process_continuous_with_failed_scene(self, fetch, mock_process):
+        """Test that download and process reports the scenes that failed"""
+        fetch.return_value = True
+        mock_process.side_effect = [SystemExit(1), 'image.TIF']
+
+        args = ['download', 'LC80010092015051LGN00', 'LC80470222014354LGN00', '-b', '432', '-d', self.mock_path, '-p']
+        output = landsat.main(self.parser.parse_args(args))
+        self.assertEqual(mock_process.call_count, 2)
+        self.assertEquals(output, ['Processing failed for LC80010092015051LGN00 (exited with code 1)', 1])
+
     def test_process_incorrect(self):
         """Test process command with incorrect input"""
         args = ['process', 'whatever']
@@ -0,0 +1,102 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""Tests for metadata"""
+
+import os
+import errno
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import mock
+
+from landsat import metadata
+from landsat.metadata import Metadata, parse_mtl, parse_value, read_metadata, sidecar_path
+
+
+MTL = """GROUP = L1_METADATA_FILE
+  GROUP = METADATA_FILE_INFO
+    ORIGIN = "Image courtesy of the U.S. Geological Survey"
+    LANDSAT_SCENE_ID = "LC80030172015001LGN00"
+    FILE_DATE = 2015-01-01T21:03:12Z
+  END_GROUP = METADATA_FILE_INFO
+  GROUP = IMAGE_ATTRIBUTES
+    CLOUD_COVER = 12.75
+    SUN_AZIMUTH = 160.82012458
+    SUN_ELEVATION = 6.37582316
+    EARTH_SUN_DISTANCE = 0.9832835
+  END_GROUP = IMAGE_ATTRIBUTES
+  GROUP = RADIOMETRIC_RESCALING
+    REFLECTANCE_MULT_BAND_4 = 2.0000E-05
+    REFLECTANCE_ADD_BAND_4 = -0.100000
+  END_GROUP = RADIOMETRIC_RESCALING
+  GROUP = PRODUCT_METADATA
+    REFLECTIVE_LINES = 7941
+  END_GROUP = PRODUCT_METADATA
+END_GROUP = L1_METADATA_FILE
+END
+"""
+
+
+class TestMetadata(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_folder = mkdtemp()
+        cls.mtl_path = os.path.join(cls.temp_folder, 'LC80030172015001LGN00_MTL.txt')
+        with open(cls.mtl_path, 'w') as f:
+            f.write(MTL)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            shutil.rmtree(cls.temp_folder)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def test_parse_value(self):
+        self.assertEqual(parse_value('"LC80030172015001LGN00"'), 'LC80030172015001LGN00')
+        self.assertEqual(parse_value('7941'), 7941)
+        self.assertEqual(parse_value('2.0000E-05'), 2e-05)
+        self.assertEqual(parse_value('2015-01-01T21:03:12Z'), '2015-01-01T21:03:12Z')
+
+    def test_parse_mtl(self):
+        groups = parse_mtl(MTL.splitlines())
+
+        self.assertEqual(list(groups), ['L1_METADATA_FILE'])
+        self.assertEqual(groups['L1_METADATA_FILE']['IMAGE_ATTRIBUTES']['CLOUD_COVER'], 12.75)
+        self.assertEqual(groups['L1_METADATA_FILE']['PRODUCT_METADATA'], {'REFLECTIVE_LINES': 7941})
+
+    def test_metadata(self):
+        m = Metadata(parse_mtl(MTL.splitlines()))
+
+        self.assertEqual(m['LANDSAT_SCENE_ID'], 'LC80030172015001LGN00')
+        self.assertEqual(m.cloud_cover, 12.75)
+        self.assertEqual(m.sun_elevation, 6.37582316)
+        self.assertEqual(m.reflectance(4), (2e-05, -0.1))
+        self.assertIsNone(m.reflectance(8))
+        self.assertIsNone(m.radiance(4))
+        self.assertNotIn('SUN_ZENITH', m)
+
+    def test_read_metadata(self):
+        metadata._memo.clear()
+        m = read_metadata(self.mtl_path)
+
+        self.assertEqual(m.cloud_cover, 12.75)
+        self.assertTrue(os.path.exists(sidecar_path(self.mtl_path)))
+        self.assertIs(read_metadata(self.mtl_path), m)
+
+        # Another process reads the sidecar instead of the MTL file
+        metadata._memo.clear()
+        with mock.patch('landsat.metadata.parse_mtl') as mock_parse:
+            self.assertEqual(read_metadata(self.mtl_path).groups, m.groups)
+            self.assertFalse(mock_parse.called)
+
+    def test_read_metadata_missing(self):
+        self.assertRaises(OSError, read_metadata, os.path.join(self.temp_folder, 'missing_MTL.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Landsat Util
+# License: CC0 1.0 Universal
+
+"""Tests for stats"""
+
+import unittest
+
+import numpy
+
+from landsat.stats import Histogram
+
+
+class TestHistogram(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.band = numpy.random.RandomState(0).randint(0, 65536, size=(200, 300)).astype(numpy.uint16)
+        cls.valid = cls.band[numpy.logical_and(cls.band > 0, cls.band < 65535)]
+
+    def test_percentiles(self):
+        histogram = Histogram().update(self.band)
+
+        for q in [0, 2.5, 50, 97.3, 100]:
+            self.assertAlmostEqual(histogram.percentiles([q])[0], numpy.percentile(self.valid, q))
+
+    def test_percentiles_ignore_nodata(self):
+        band = numpy.array([0, 0, 0, 10, 20, 65535], dtype=numpy.uint16)
+        histogram = Histogram().update(band)
+
+        self.assertEqual(histogram.percentiles([0, 50, 100]), [10.0, 15.0, 20.0])
+
+    def test_percentiles_empty(self):
+        histogram = Histogram().update(numpy.zeros((10, 10), dtype=numpy.uint16))
+
+        self.assertEqual(histogram.percentiles([0, 100]), [0.0, 0.0])
+
+    def test_update_by_blocks(self):
+        histogram = Histogram()
+        for row in range(0, self.band.shape[0], 64):
+            histogram.update(self.band[row:row + 64])
+
+        numpy.testing.assert_array_equal(histogram.counts, Histogram().update(self.band).counts)
+
+    def test_merge(self):
+        first = Histogram().update(self.band[:100])
+        second = Histogram().update(self.band[100:])
+
+        numpy.testing.assert_array_equal(first.merge(second).counts, Histogram().update(self.band).counts)
+
+    def test_cuts(self):
+        p_low, p_high, high_range = Histogram().update(self.band).cuts(0, 90)
+        above = self.band[self.band >= p_high]
+
+        self.assertAlmostEqual(p_low, numpy.percentile(self.valid, 0))
+        self.assertAlmostEqual(p_high, numpy.percentile(self.valid, 90))
+        self.assertEqual(high_range, (above.min(), above.max()))
+
+
+if __name__ == '__main__':
+    unittest.main()